@@ -0,0 +1,94 @@
+import asyncio
+import logging
+import time
+from collections import deque
+
+import aiohttp
+
+
+class ClientConnection:
+    """
+    Outbound side of a websocket. Frames are queued in a buffer of at most max_buffer frames that a task of its own
+    sends, so a slow client only ever delays itself. When the buffer is full the oldest frame that a later one
+    supersedes (status, progress, previews) is dropped to make room, with overflow="disconnect" or when there is no
+    such frame the client is disconnected instead and has to resync when it reconnects.
+    """
+
+    def __init__(self, ws, batch=False, max_buffer=1000, overflow="drop"):
+        self.ws = ws
+        # whether the client accepts {"type": "batch"} frames
+        self.batch = batch
+        self.max_buffer = max_buffer
+        self.overflow = overflow
+        self.buffer = deque()
+        self.ready = asyncio.Event()
+        self.closed = False
+        self.task = None
+        self.sent = 0
+        self.dropped = 0
+        self.lag = 0.0
+        self.max_lag = 0.0
+
+    def start(self):
+        self.task = asyncio.ensure_future(self.run())
+
+    def enqueue(self, frame, droppable=False):
+        # frame is str or bytes, already serialized so broadcasts encode their message only once
+        if self.closed:
+            return
+        if len(self.buffer) >= self.max_buffer and not self.make_room():
+            logging.warning("websocket client too slow, {} frames behind, disconnecting".format(len(self.buffer)))
+            self.close()
+            return
+        self.buffer.append((frame, droppable, time.perf_counter()))
+        self.ready.set()
+
+    def make_room(self):
+        if self.overflow != "drop":
+            return False
+        for i, (_, droppable, _) in enumerate(self.buffer):
+            if droppable:
+                del self.buffer[i]
+                self.dropped += 1
+                return True
+        return False
+
+    async def run(self):
+        while not self.closed:
+            await self.ready.wait()
+            self.ready.clear()
+            while len(self.buffer) > 0 and not self.closed:
+                frame, _, queued = self.buffer.popleft()
+                try:
+                    if isinstance(frame, str):
+                        await self.ws.send_str(frame)
+                    else:
+                        await self.ws.send_bytes(frame)
+                except (aiohttp.ClientError, aiohttp.ClientPayloadError, ConnectionResetError) as err:
+                    # the rest would go to a dead socket, the client resyncs when it reconnects
+                    logging.warning("send error, disconnecting: {}".format(err))
+                    self.close()
+                    return
+                self.sent += 1
+                self.lag = time.perf_counter() - queued
+                self.max_lag = max(self.max_lag, self.lag)
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.buffer.clear()
+        self.ready.set()
+        if not self.ws.closed:
+            asyncio.ensure_future(self.ws.close())
+
+    def stats(self):
+        return {
+            "buffered": len(self.buffer),
+            "max_buffer": self.max_buffer,
+            "sent": self.sent,
+            "dropped": self.dropped,
+            # seconds the last sent frame spent in the buffer, and the worst seen so far
+            "lag": self.lag,
+            "max_lag": self.max_lag,
+        }
@@ -0,0 +1,123 @@
+import logging
+import os
+import re
+import sqlite3
+import threading
+
+from app.uploads import UPLOAD_CHUNK_SIZE
+
+
+def hash_file(filepath, hasher):
+    h = hasher()
+    with open(filepath, "rb") as f:
+        for chunk in iter(lambda: f.read(UPLOAD_CHUNK_SIZE), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class HashIndex:
+    """
+    Content digests of the files in the upload directories, stored in SQLite by absolute path together with the size
+    and mtime they were taken at, so a file is only hashed again after it changed. Uploads record their digest when
+    they are stored, which is what lets find_duplicate answer with one query. The database is opened on first use,
+    if that fails digests are computed every time like before.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.connection = None
+        self.failed = False
+
+    def connect(self):
+        if self.connection is None and not self.failed:
+            try:
+                os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+                connection = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+                with connection:
+                    connection.execute("PRAGMA journal_mode=WAL")
+                    connection.execute("CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, directory TEXT, "
+                                       "algorithm TEXT, size INTEGER, mtime INTEGER, digest TEXT)")
+                    connection.execute("CREATE INDEX IF NOT EXISTS files_digest ON files (digest, directory)")
+                self.connection = connection
+            except sqlite3.Error as e:
+                logging.warning("Can't open the upload hash index {}, uploads will be hashed every time: {}"
+                                .format(self.path, e))
+                self.failed = True
+        return self.connection
+
+    def lookup(self, filepath, stat, algorithm):
+        with self.lock:
+            if self.connect() is None:
+                return None
+            row = self.connection.execute("SELECT algorithm, size, mtime, digest FROM files WHERE path = ?",
+                                          (filepath,)).fetchone()
+        if row is not None and row[:3] == (algorithm, stat.st_size, stat.st_mtime_ns):
+            return row[3]
+        return None
+
+    def record(self, filepath, digest, algorithm, stat=None):
+        filepath = os.path.abspath(filepath)
+        if stat is None:
+            stat = os.stat(filepath)
+        with self.lock:
+            if self.connect() is None:
+                return
+            with self.connection:
+                self.connection.execute("INSERT OR REPLACE INTO files (path, directory, algorithm, size, mtime, digest) "
+                                        "VALUES (?, ?, ?, ?, ?, ?)",
+                                        (filepath, os.path.dirname(filepath), algorithm, stat.st_size,
+                                         stat.st_mtime_ns, digest))
+
+    def forget(self, filepath):
+        with self.lock:
+            if self.connect() is None:
+                return
+            with self.connection:
+                self.connection.execute("DELETE FROM files WHERE path = ?", (filepath,))
+
+    def digest(self, filepath, hasher):
+        # digest of the file at filepath, read from the index while the file's size and mtime match
+        filepath = os.path.abspath(filepath)
+        algorithm = hasher().name
+        stat = os.stat(filepath)
+        digest = self.lookup(filepath, stat, algorithm)
+        if digest is None:
+            digest = hash_file(filepath, hasher)
+            self.record(filepath, digest, algorithm, stat)
+        return digest
+
+    def find_duplicate(self, directory, filename, size, digest, hasher):
+        """
+        The name of the file in directory that an upload of filename with this content would be a duplicate of:
+        filename itself or one of the "name (i).ext" names uploads get on conflicts, lowest i first. None when the
+        index knows of no such file, files it doesn't know about yet are left to the caller.
+        """
+        directory = os.path.abspath(directory)
+        algorithm = hasher().name
+        with self.lock:
+            if self.connect() is None:
+                return None
+            rows = self.connection.execute("SELECT path, size, mtime FROM files WHERE digest = ? AND directory = ? "
+                                           "AND algorithm = ?", (digest, directory, algorithm)).fetchall()
+
+        stem, ext = os.path.splitext(filename)
+        series = re.compile(r"{} \((\d+)\){}".format(re.escape(stem), re.escape(ext)))
+        found = []
+        for path, stored_size, mtime in rows:
+            name = os.path.basename(path)
+            if name == filename:
+                order = 0
+            else:
+                match = series.fullmatch(name)
+                if match is None:
+                    continue
+                order = int(match.group(1))
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                self.forget(path)
+                continue
+            if stat.st_size == size == stored_size and stat.st_mtime_ns == mtime:
+                found.append((order, name))
+        return min(found)[1] if len(found) > 0 else None
@@ -0,0 +1,85 @@
+import asyncio
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from aiohttp import web
+
+
+def default_workers():
+    return max(1, min(4, os.cpu_count() or 1))
+
+
+class ImageExecutor:
+    """
+    Threads for the image work of request handlers (decoding, converting and encoding with PIL, which releases the
+    GIL for most of it), so previews never run on the event loop and can only ever take max_workers threads. With
+    max_queue set, requests arriving while that many already wait are answered with 503 instead of piling up.
+    """
+
+    def __init__(self, max_workers=None, max_queue=0):
+        self.max_workers = max_workers or default_workers()
+        self.max_queue = max_queue
+        self.executor = ThreadPoolExecutor(self.max_workers, thread_name_prefix="image")
+        self.lock = threading.Lock()
+        self.queued = 0
+        self.running = 0
+        self.completed = 0
+        self.failed = 0
+        self.rejected = 0
+        self.max_queued = 0
+        self.wait = 0.0
+        self.max_wait = 0.0
+
+    async def run(self, function, *args):
+        with self.lock:
+            if self.max_queue > 0 and self.queued >= self.max_queue:
+                self.rejected += 1
+                raise web.HTTPServiceUnavailable(text="Too many image requests waiting")
+            self.queued += 1
+            self.max_queued = max(self.max_queued, self.queued)
+        submitted = time.perf_counter()
+
+        def call():
+            with self.lock:
+                self.queued -= 1
+                self.running += 1
+                self.wait = time.perf_counter() - submitted
+                self.max_wait = max(self.max_wait, self.wait)
+            try:
+                return function(*args)
+            except BaseException:
+                with self.lock:
+                    self.failed += 1
+                raise
+            finally:
+                with self.lock:
+                    self.running -= 1
+                    self.completed += 1
+
+        def cancelled(future):
+            # the request went away before a thread picked it up, call never runs
+            if future.cancelled():
+                with self.lock:
+                    self.queued -= 1
+
+        future = self.executor.submit(call)
+        future.add_done_callback(cancelled)
+        return await asyncio.wrap_future(future)
+
+    def stats(self):
+        with self.lock:
+            return {
+                "max_workers": self.max_workers,
+                "max_queue": self.max_queue,
+                "queued": self.queued,
+                "running": self.running,
+                "completed": self.completed,
+                "failed": self.failed,
+                "rejected": self.rejected,
+                "max_queued": self.max_queued,
+                # seconds the last request waited for a thread, and the longest wait so far
+                "wait": self.wait,
+                "max_wait": self.max_wait,
+            }
@@ -0,0 +1,187 @@
+import hashlib
+import logging
+import os
+import threading
+import traceback
+import uuid
+
+import folder_paths
+import nodes
+from comfy import json_util
+from comfy.folder_index import RootIndex
+
+
+def node_info(node_class):
+    """
+    获取节点信息
+    :param node_class:
+    :return:
+    """
+    obj_class = nodes.NODE_CLASS_MAPPINGS[node_class]
+    info = {}
+    info['input'] = obj_class.INPUT_TYPES()
+    info['output'] = obj_class.RETURN_TYPES
+    info['output_is_list'] = obj_class.OUTPUT_IS_LIST if hasattr(obj_class, 'OUTPUT_IS_LIST') else [
+                                                                                                       False] * len(
+        obj_class.RETURN_TYPES)
+    info['output_name'] = obj_class.RETURN_NAMES if hasattr(obj_class, 'RETURN_NAMES') else info['output']
+    info['name'] = node_class
+    info['display_name'] = nodes.NODE_DISPLAY_NAME_MAPPINGS[
+        node_class] if node_class in nodes.NODE_DISPLAY_NAME_MAPPINGS.keys() else node_class
+    info['description'] = obj_class.DESCRIPTION if hasattr(obj_class, 'DESCRIPTION') else ''
+    info['python_module'] = getattr(obj_class, "RELATIVE_PYTHON_MODULE", "nodes")
+    info['category'] = 'sd'
+    if hasattr(obj_class, 'OUTPUT_NODE') and obj_class.OUTPUT_NODE == True:
+        info['output_node'] = True
+    else:
+        info['output_node'] = False
+
+    if hasattr(obj_class, 'CATEGORY'):
+        info['category'] = obj_class.CATEGORY
+    return info
+
+
+class ObjectInfoCache:
+    """
+    The /object_info document, serialized once and rebuilt only when it may have changed: nodes were registered,
+    or something changed in a directory INPUT_TYPES lists (the input directory and the model folders, plus any
+    path added with watch). A directory's mtime changes whenever an entry is added, removed or renamed in it,
+    so checking costs one stat per watched directory and subdirectory, only changed ones are listed again. With
+    the file index enabled the model folders are taken from it instead, it replaces their index on a change.
+    Output and temp aren't watched, uploads, spilled results and save counters come and go there all the time.
+
+    Every rebuild that changes anything bumps version, and each node remembers the version its definition last
+    changed in, which is what diff uses to send clients only what changed since the version they have.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.extra_paths = set()
+        # watched directory -> (RootIndex of its subdirectories, how many times something below it changed)
+        self.trees = {}
+        self.trees_lock = threading.Lock()
+        self.stamp = None
+        self.info = {}
+        self.body = None
+        self.etag = None
+        # versions only mean something within this process, tokens carry its id
+        self.instance = uuid.uuid4().hex
+        self.version = 0
+        self.serialized = {}
+        self.node_versions = {}
+        self.removed = {}
+        nodes.add_nodes_changed_callback(self.invalidate)
+
+    def watch(self, path):
+        # for files or directories that INPUT_TYPES of a custom node reads
+        with self.lock:
+            self.extra_paths.add(os.path.abspath(path))
+
+    def invalidate(self):
+        with self.lock:
+            self.stamp = None
+
+    def model_folder_names(self):
+        return sorted(x for x in folder_paths.folder_names_and_paths if x != "custom_nodes")
+
+    def watched_paths(self):
+        paths = {folder_paths.get_input_directory()}
+        if folder_paths.file_index is None:
+            for folder_name in self.model_folder_names():
+                paths.update(folder_paths.folder_names_and_paths[folder_name][0])
+        return sorted(paths | self.extra_paths)
+
+    def current_stamp(self):
+        stamp = [len(nodes.NODE_CLASS_MAPPINGS), len(nodes.NODE_DISPLAY_NAME_MAPPINGS)]
+        with self.trees_lock:
+            paths = self.watched_paths()
+            for x in set(self.trees).difference(paths):
+                del self.trees[x]
+            for path in paths:
+                if os.path.isdir(path):
+                    stamp.append((path, self.tree_version(path)))
+                    continue
+                try:
+                    stamp.append((path, os.stat(path).st_mtime_ns))
+                except OSError:
+                    stamp.append((path, None))
+        if folder_paths.file_index is not None:
+            # the FilenameIndex objects themselves, a changed folder gets a new one
+            stamp.extend((x, folder_paths.get_filename_index(x)) for x in self.model_folder_names())
+        return stamp
+
+    def tree_version(self, directory):
+        # model folders have subfolders (loras/sdxl/...), a change in any of them counts
+        tree, version = self.trees.get(directory, (None, 0))
+        if tree is None:
+            tree = RootIndex(directory, ())
+            tree.scan()
+        elif tree.poll():
+            version += 1
+        self.trees[directory] = (tree, version)
+        return version
+
+    def get(self):
+        # returns (info, body, etag), rebuilding them first if anything they depend on changed
+        stamp = self.current_stamp()
+        with self.lock:
+            if stamp != self.stamp:
+                self.rebuild()
+                self.stamp = stamp
+            return self.info, self.body, self.etag
+
+    def rebuild(self):
+        info = build_object_info()
+        serialized = {x: json_util.dumps_bytes(v) for x, v in info.items()}
+        changed = [x for x in serialized if self.serialized.get(x, None) != serialized[x]]
+        removed = [x for x in self.serialized if x not in serialized]
+        if self.body is not None and len(changed) == 0 and len(removed) == 0:
+            return
+
+        self.version += 1
+        for x in changed:
+            self.node_versions[x] = self.version
+            self.removed.pop(x, None)
+        for x in removed:
+            self.node_versions.pop(x, None)
+            self.removed[x] = self.version
+        self.info = info
+        self.serialized = serialized
+        # the document is put together from the nodes already serialized for the comparison
+        self.body = b"{" + b",".join(json_util.dumps_bytes(x) + b":" + v for x, v in serialized.items()) + b"}"
+        self.etag = '"{}"'.format(hashlib.sha1(self.body).hexdigest())
+
+    def token(self):
+        return "{}:{}".format(self.instance, self.version)
+
+    def diff(self, since=None):
+        """
+        Node definitions changed since the version token since, {"version": token, "full": bool,
+        "changed": {name: info}, "removed": [name]}. Tokens from another process, or none, get every node.
+        """
+        self.get()
+        with self.lock:
+            version = None
+            if since is not None:
+                instance, _, number = since.partition(":")
+                if instance == self.instance and number.isdigit() and int(number) <= self.version:
+                    version = int(number)
+
+            if version is None:
+                changed = self.info
+                removed = []
+            else:
+                changed = {x: self.info[x] for x, v in self.node_versions.items() if v > version}
+                removed = [x for x, v in self.removed.items() if v > version]
+            return {"version": self.token(), "full": version is None, "changed": changed, "removed": removed}
+
+
+def build_object_info():
+    out = {}
+    for x in list(nodes.NODE_CLASS_MAPPINGS):
+        try:
+            out[x] = node_info(x)
+        except Exception as e:
+            logging.error(f"[ERROR] An error occurred while retrieving information for the '{x}' node.")
+            logging.error(traceback.format_exc())
+    return out
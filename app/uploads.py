@@ -0,0 +1,146 @@
+import asyncio
+import os
+import shutil
+import tempfile
+
+from aiohttp import web
+
+# bytes read from the request and written to disk at a time, and so about what an upload holds in memory
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+
+# mkstemp creates files only their owner can read, stored uploads get the mode open() would have given them.
+# The umask can only be read by setting it, which is done once here rather than from the handler threads.
+UMASK = os.umask(0)
+os.umask(UMASK)
+FILE_MODE = 0o666 & ~UMASK
+
+
+class UploadedFile:
+    """
+    A file part of a multipart upload, streamed to a staging file while it was received and hashed on the way.
+    file opens the staged file for reading, for code written against the FileField of request.post().
+    """
+
+    def __init__(self, name, filename, content_type, path):
+        self.name = name
+        self.filename = filename
+        self.content_type = content_type
+        self.path = path
+        self.size = 0
+        self.digest = None
+        self._file = None
+
+    @property
+    def file(self):
+        if self._file is None:
+            self._file = open(self.path, "rb")
+        return self._file
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def discard(self):
+        self.close()
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+    def store(self, filepath):
+        """
+        Moves the staged file to filepath. Within one filesystem that is a rename, so readers of filepath see either
+        the previous file or the complete upload. Otherwise it is copied next to filepath first and renamed there.
+        """
+        self.close()
+        os.chmod(self.path, FILE_MODE)
+        try:
+            os.replace(self.path, filepath)
+        except OSError:
+            fd, partial = tempfile.mkstemp(prefix=".upload-", suffix=".part", dir=os.path.dirname(filepath))
+            os.close(fd)
+            try:
+                shutil.copyfile(self.path, partial)
+                os.chmod(partial, FILE_MODE)
+                os.replace(partial, filepath)
+            except BaseException:
+                os.remove(partial)
+                raise
+            os.remove(self.path)
+
+
+def write_chunk(f, hash, chunk):
+    f.write(chunk)
+    hash.update(chunk)
+
+
+async def read_multipart(request, stage_dir, hasher, max_size=None, chunk_size=UPLOAD_CHUNK_SIZE):
+    """
+    Reads a multipart/form-data request without buffering it. File parts are streamed to files in stage_dir chunk by
+    chunk and become UploadedFile, other fields are returned as str. Writing and hashing run in the default executor
+    so the event loop only waits on the network. Bodies over max_size bytes are rejected with 413. Other bodies are
+    read with request.post(), they carry no files, so the upload handlers answer 400 for the missing file.
+    """
+    if request.content_type != "multipart/form-data":
+        # a url encoded form has fields but no files, any other body reads as an empty form
+        return first_values(await request.post())
+
+    loop = asyncio.get_running_loop()
+    post = {}
+    total = 0
+    try:
+        reader = await request.multipart()
+        while True:
+            part = await reader.next()
+            if part is None:
+                break
+            if part.name in post:
+                # like request.post().get, the first part of a name wins
+                await part.release()
+                continue
+
+            if part.filename is None:
+                value = await part.text()
+                total += len(value)
+                if max_size is not None and total > max_size:
+                    raise web.HTTPRequestEntityTooLarge(max_size=max_size, actual_size=total)
+                post[part.name] = value
+                continue
+
+            await loop.run_in_executor(None, lambda: os.makedirs(stage_dir, exist_ok=True))
+            fd, path = tempfile.mkstemp(prefix=".upload-", suffix=".part", dir=stage_dir)
+            upload = UploadedFile(part.name, part.filename, part.headers.get("Content-Type"), path)
+            post[part.name] = upload
+
+            hash = hasher()
+            with os.fdopen(fd, "wb") as f:
+                while True:
+                    chunk = await part.read_chunk(chunk_size)
+                    if not chunk:
+                        break
+                    upload.size += len(chunk)
+                    total += len(chunk)
+                    if max_size is not None and total > max_size:
+                        raise web.HTTPRequestEntityTooLarge(max_size=max_size, actual_size=total)
+                    await loop.run_in_executor(None, write_chunk, f, hash, chunk)
+            upload.digest = hash.hexdigest()
+    except BaseException:
+        discard_uploads(post)
+        raise
+    return post
+
+
+def first_values(form):
+    # a dict of the first value of every name, like request.post().get
+    post = {}
+    for name, value in form.items():
+        post.setdefault(name, value)
+    return post
+
+
+def discard_uploads(post):
+    # removes whatever was staged and not stored
+    for value in post.values():
+        if isinstance(value, UploadedFile):
+            value.discard()
@@ -0,0 +1,82 @@
+"""
+Compares the cost of encoding a large /history payload with each backend of comfy.json_util, and with the
+json.dumps call PromptServer used before.
+
+The history holds entries shaped like the ones PromptQueue.task_done stores, with a prompt of a few dozen nodes
+and ui outputs that include NumPy arrays.
+
+    python benchmarks/json_encoding.py --entries 1000 10000
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+from comfy import json_util
+
+
+def build_history(entry_count, nodes_per_prompt, with_arrays):
+    history = {}
+    for i in range(entry_count):
+        prompt_id = "prompt{}".format(i)
+        prompt = {}
+        for j in range(nodes_per_prompt):
+            inputs = {"text": "value {}".format(j), "seed": j * 7919}
+            if j > 0:
+                inputs["input"] = [str(j - 1), 0]
+            prompt[str(j)] = {"class_type": "StringFunction|pysssss", "inputs": inputs}
+        outputs = {str(nodes_per_prompt - 1): {"text": ["result {}".format(i)] * 4,
+                                               "values": [float(x) for x in range(16)]}}
+        if with_arrays:
+            outputs[str(nodes_per_prompt - 1)]["matrix"] = [np.arange(64, dtype=np.float32).reshape(8, 8)]
+        history[prompt_id] = {
+            "prompt": (i, prompt_id, prompt, {"client_id": "client{}".format(i % 8)}, [str(nodes_per_prompt - 1)]),
+            "outputs": outputs,
+            "status": {"status_str": "success", "completed": True, "messages": [("execution_start", {"prompt_id": prompt_id, "timestamp": 0})]},
+        }
+    return history
+
+
+def legacy_dumps(value):
+    # what web.json_response and send_json did, numpy arrays had to be converted up front
+    return json.dumps(value).encode("utf-8")
+
+
+def measure(function, value, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        data = function(value)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, len(data)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--entries", type=int, nargs="+", default=[1000, 10000])
+    parser.add_argument("--nodes", type=int, default=30, help="nodes per prompt")
+    parser.add_argument("--repeat", type=int, default=5)
+    options = parser.parse_args()
+
+    for entry_count in options.entries:
+        plain = build_history(entry_count, options.nodes, with_arrays=False)
+        arrays = build_history(entry_count, options.nodes, with_arrays=True)
+        results = [("stdlib json.dumps (before)", measure(legacy_dumps, plain, options.repeat))]
+        for name in json_util.BACKENDS:
+            json_util.set_backend(name)
+            results.append((name, measure(json_util.dumps_bytes, plain, options.repeat)))
+            results.append((name + " with numpy", measure(json_util.dumps_bytes, arrays, options.repeat)))
+
+        print("{} history entries".format(entry_count))
+        for name, (elapsed, size) in results:
+            print("  {:30} {:8.1f} ms {:10.1f} KiB".format(name, elapsed * 1000, size / 1024))
+
+
+if __name__ == "__main__":
+    main()
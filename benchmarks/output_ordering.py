@@ -0,0 +1,141 @@
+"""
+Compares the output ordering of PromptExecutor.execute before and after OutputScheduler.
+
+The prompt is a shared chain of nodes with every output node hanging off it through a short branch of its own,
+nodes are not actually run, the benchmark only measures picking the next output and bookkeeping. Before timing,
+both orders are compared on a small prompt of diamonds, where nodes are reached through several paths.
+
+    python benchmarks/output_ordering.py --outputs 1000 2000 5000 10000
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+from comfy_execution.graph import PromptGraph, OutputScheduler
+
+
+def build_prompt(output_count, chain_length):
+    prompt = {}
+    for i in range(chain_length):
+        inputs = {"text": str(i)} if i == 0 else {"text": ["chain{}".format(i - 1), 0]}
+        prompt["chain{}".format(i)] = {"class_type": "StringFunction|pysssss", "inputs": inputs}
+    output_ids = []
+    for i in range(output_count):
+        upstream = "chain{}".format(i % chain_length)
+        for j in range(i % 4):
+            node_id = "branch{}_{}".format(i, j)
+            prompt[node_id] = {"class_type": "StringFunction|pysssss", "inputs": {"text": [upstream, 0]}}
+            upstream = node_id
+        node_id = "output{}".format(i)
+        prompt[node_id] = {"class_type": "ToString", "inputs": {"obj": [upstream, 0]}}
+        output_ids.append(node_id)
+    return prompt, output_ids
+
+
+def build_diamond_prompt(output_count, layers, width):
+    # every node reads the node above it and the one right of that, so most nodes are reached through several paths
+    prompt = {}
+    for i in range(width):
+        prompt["layer0_{}".format(i)] = {"class_type": "StringFunction|pysssss", "inputs": {"text": str(i)}}
+    for layer in range(1, layers):
+        for i in range(width):
+            inputs = {"text_a": ["layer{}_{}".format(layer - 1, i), 0], "text_b": ["layer{}_{}".format(layer - 1, min(i + 1, width - 1)), 0]}
+            prompt["layer{}_{}".format(layer, i)] = {"class_type": "StringFunction|pysssss", "inputs": inputs}
+    output_ids = []
+    for i in range(output_count):
+        node_id = "output{}".format(i)
+        upstream = "layer{}_{}".format((i * 7) % layers, (i * 3) % width)
+        prompt[node_id] = {"class_type": "ToString", "inputs": {"obj": [upstream, 0]}}
+        output_ids.append(node_id)
+    return prompt, output_ids
+
+
+def recursive_will_execute(prompt, outputs, current_item, memo={}):
+    # execution.recursive_will_execute as it was before OutputScheduler, copied unchanged
+    unique_id = current_item
+
+    if unique_id in memo:
+        return memo[unique_id]
+
+    inputs = prompt[unique_id]['inputs']
+    will_execute = []
+    if unique_id in outputs:
+        return []
+
+    for x in inputs:
+        input_data = inputs[x]
+        if isinstance(input_data, list):
+            input_unique_id = input_data[0]
+            output_index = input_data[1]
+            if input_unique_id not in outputs:
+                will_execute += recursive_will_execute(prompt, outputs, input_unique_id, memo)
+
+    memo[unique_id] = will_execute + [unique_id]
+    return memo[unique_id]
+
+
+def legacy_order(prompt, graph, output_ids):
+    # the loop PromptExecutor.execute used: re-sort every remaining output after each one, with a fresh memo
+    outputs = {}
+    order = []
+    to_execute = [(0, x) for x in output_ids]
+    while len(to_execute) > 0:
+        memo = {}
+        to_execute = sorted(list(map(lambda a: (len(recursive_will_execute(prompt, outputs, a[-1], memo)), a[-1]), to_execute)))
+        output_node_id = to_execute.pop(0)[-1]
+        # stands in for recursive_execute, which stores the output of every node it ran
+        for x in graph.pending([output_node_id], outputs):
+            outputs[x] = True
+        order.append(output_node_id)
+    return order
+
+
+def scheduled_order(graph, output_ids):
+    outputs = {}
+    order = []
+    scheduler = OutputScheduler(graph, output_ids, outputs)
+    while len(scheduler) > 0:
+        output_node_id = scheduler.pop()
+        for x in graph.pending([output_node_id], outputs):
+            outputs[x] = True
+        scheduler.done(output_node_id)
+        order.append(output_node_id)
+    return order
+
+
+def timed(function, *args):
+    start = time.perf_counter()
+    result = function(*args)
+    return time.perf_counter() - start, result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--outputs", type=int, nargs="+", default=[1000, 2000, 5000, 10000])
+    parser.add_argument("--chain-length", type=int, default=200)
+    parser.add_argument("--legacy-max", type=int, default=1000, help="Skip the legacy loop above this many outputs.")
+    options = parser.parse_args()
+
+    # the old count has a node once per path to it, check the scheduler keeps that where paths join again
+    prompt, output_ids = build_diamond_prompt(40, 6, 4)
+    graph = PromptGraph(prompt)
+    assert legacy_order(prompt, graph, output_ids) == scheduled_order(graph, output_ids), "output order differs from the legacy loop on the diamond prompt"
+
+    print("{:>8} {:>8} {:>12} {:>14}".format("outputs", "nodes", "legacy (s)", "scheduler (s)"))
+    for output_count in options.outputs:
+        prompt, output_ids = build_prompt(output_count, options.chain_length)
+        graph = PromptGraph(prompt)
+        scheduled_time, scheduled = timed(scheduled_order, graph, output_ids)
+        legacy = "skipped"
+        if output_count <= options.legacy_max:
+            legacy_time, legacy_result = timed(legacy_order, prompt, graph, output_ids)
+            assert legacy_result == scheduled, "output order differs from the legacy loop"
+            legacy = "{:.3f}".format(legacy_time)
+        print("{:>8} {:>8} {:>12} {:>14.3f}".format(output_count, len(prompt), legacy, scheduled_time))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,6 @@
 import argparse
 import enum
+import math
 import os
 from typing import Optional
 import comfy.options
@@ -117,6 +118,51 @@ parser.add_argument("--default-hashing-function", type=str, choices=['md5', 'sha
 parser.add_argument("--disable-smart-memory", action="store_true", help="Force ComfyUI to agressively offload to regular ram instead of keeping models in vram when it can.")
 parser.add_argument("--deterministic", action="store_true", help="Make pytorch use slower deterministic algorithms when it can. Note that this might not make images deterministic in all cases.")
 
+parser.add_argument("--workers", type=int, default=1, metavar="N", help="Run prompts in N executor processes pulling from the same queue, so one long prompt doesn't hold up the others. Each process has its own copy of module state, e.g. a variable set by PutVariable in a prompt is only seen by GetVariable in prompts run by the same process.")
+
+parser.add_argument("--execution-threads", type=int, default=1, metavar="N", help="Run independent nodes of a prompt concurrently on a pool of N threads. The default of 1 executes nodes one after another. Nodes that set NOT_PARALLEL, like PutVariable and GetVariable, run one at a time while no other node runs, but a GetVariable without a link to its PutVariable may still run first.")
+
+parser.add_argument("--cache-lru", type=int, default=0, metavar="N", help="Besides the results of the last prompt, keep up to N node results of earlier prompts, reused by any prompt containing the same node with the same inputs.")
+
+parser.add_argument("--cache-max-bytes", type=int, default=None, metavar="BYTES", help="Limit the estimated size of cached node results, the least recently used results are dropped and computed again when needed.")
+
+parser.add_argument("--cache-spill-bytes", type=int, default=0, metavar="BYTES", help="Instead of dropping large NumPy array and bytes results evicted from the cache, keep up to BYTES of them in memory-mapped files under the temp directory.")
+
+parser.add_argument("--persistent-cache", type=str, default=None, metavar="PATH", nargs="?", const="", help="Keep the results of nodes declaring DETERMINISTIC or CACHE_TTL in an SQLite file that survives restarts and is shared by every process using it (default: user/output_cache.db).")
+
+parser.add_argument("--ws-batch-interval", type=float, default=0, metavar="MS", help="Publish websocket events in batches every MS milliseconds, status and progress updates superseded within a batch are dropped. Only clients connecting with batch=1 receive batch frames. The default of 0 sends every event as it comes.")
+
+parser.add_argument("--ws-buffer-size", type=int, default=1000, metavar="N", help="Maximum number of frames waiting to be sent to a websocket client.")
+parser.add_argument("--ws-overflow", type=str, default="drop", choices=["drop", "disconnect"], help="What happens when a client falls --ws-buffer-size frames behind: drop its oldest status/progress/preview frames, or disconnect it.")
+
+parser.add_argument("--file-index", action="store_true", help="Keep the file lists of the model folders in memory, updated from filesystem events when watchdog is installed and by polling directory mtimes otherwise, instead of checking the folders on every lookup.")
+parser.add_argument("--file-index-poll-interval", type=float, default=5.0, metavar="SECONDS", help="How often --file-index polls the folders when watchdog isn't installed.")
+
+parser.add_argument("--history-max-bytes", type=int, default=None, metavar="BYTES", help="Besides keeping at most 10000 finished prompts in the history, drop the oldest ones once their estimated size exceeds BYTES.")
+
+parser.add_argument("--queue-db", type=str, default=None, metavar="PATH", nargs="?", const="", help="Save the queue and history to an SQLite file, so queued prompts and results survive a restart or crash (default: user/queue.db).")
+parser.add_argument("--queue-db-sync-interval", type=float, default=0.2, metavar="SECONDS", help="How often --queue-db writes out the changes made since the last write, in one transaction.")
+
+parser.add_argument("--fair-share", type=str, default=None, choices=["client", "user"], help="Instead of running queued prompts strictly in order, take turns between the clients (or users with --multi-user) that queued them, so one client queueing many prompts can't hold up the others.")
+
+
+def tenant_weight(value: str) -> tuple:
+    """Parse TENANT=WEIGHT with a positive weight."""
+    tenant, _, weight = value.rpartition("=")
+    try:
+        weight = float(weight)
+    except ValueError:
+        weight = 0
+    if not tenant or not (weight > 0 and math.isfinite(weight)):
+        raise argparse.ArgumentTypeError(f"{value} is not TENANT=WEIGHT with a positive weight.")
+    return tenant, weight
+
+parser.add_argument("--fair-share-weight", type=tenant_weight, default=[], metavar="TENANT=WEIGHT", action="append", help="With --fair-share, let TENANT start WEIGHT prompts per turn instead of 1, can be given multiple times.")
+parser.add_argument("--tenant-max-running", type=int, default=0, metavar="N", help="With --fair-share, never run more than N prompts of the same client or user at once, 0 for no limit.")
+
+parser.add_argument("--image-workers", type=int, default=None, metavar="N", help="Threads decoding and encoding images for /view previews and mask uploads (default: up to 4, one per CPU).")
+parser.add_argument("--image-queue-size", type=int, default=0, metavar="N", help="Answer image requests with 503 while N are already waiting for an image thread, 0 for no limit.")
+
 parser.add_argument("--dont-print-server", action="store_true", help="Don't print server output.")
 parser.add_argument("--quick-test-for-ci", action="store_true", help="Quick test for CI.")
 parser.add_argument("--windows-standalone-build", action="store_true", help="Windows standalone build: Enable convenient things that most people using the standalone windows build will probably enjoy (like auto opening the page on startup).")
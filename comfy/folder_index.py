@@ -0,0 +1,247 @@
+"""
+In-memory index of the files in the folders of folder_paths, so get_filename_list and get_full_path don't touch
+the filesystem. Each indexed directory keeps the files and subdirectories it directly contains, and when one
+changes only that directory is listed again. Changes are picked up from filesystem events through watchdog
+(inotify on Linux) when it is installed, otherwise by a thread comparing directory mtimes every poll_interval
+seconds.
+"""
+import logging
+import os
+import threading
+
+try:
+    from watchdog.events import FileSystemEventHandler
+    from watchdog.observers import Observer
+except ImportError:
+    Observer = None
+    FileSystemEventHandler = object
+
+EXCLUDED_DIR_NAMES = (".git",)
+
+
+class FilenameIndex:
+    """
+    Resolves the filenames of a folder name to absolute paths with dictionary lookups.
+
+    paths     - relative filename -> absolute path
+    filenames - sorted relative filenames
+    """
+
+    def __init__(self, paths):
+        self.paths = paths
+        self.filenames = sorted(paths)
+        self.lowercase = {}
+        self.stems = {}
+        for filename in self.filenames:
+            lower = filename.lower()
+            self.lowercase.setdefault(lower, filename)
+            self.stems.setdefault(os.path.splitext(lower)[0], filename)
+
+    def find(self, name):
+        """
+        Case insensitive lookup of name as a filename or as a filename without extension, the first matching
+        filename in sorted order wins.
+        """
+        name = name.lower()
+        candidates = [x for x in (self.lowercase.get(name, None), self.stems.get(name, None)) if x is not None]
+        if len(candidates) == 0:
+            return None
+        return self.paths[min(candidates)]
+
+
+class RootIndex:
+    # files below one directory registered for a folder name, by path relative to it
+
+    def __init__(self, root, extensions):
+        self.root = root
+        self.extensions = extensions
+        self.dirs = {}
+        self.files = {}
+
+    def accepts(self, relative_path):
+        return len(self.extensions) == 0 or os.path.splitext(relative_path)[-1].lower() in self.extensions
+
+    def scan(self):
+        self.dirs = {}
+        self.files = {}
+        if os.path.isdir(self.root):
+            self.refresh(self.root)
+
+    def refresh(self, directory):
+        """
+        Lists directory again and applies the difference, new subdirectories are scanned and vanished ones dropped
+        with everything below them. Returns whether anything changed.
+        """
+        try:
+            mtime = os.stat(directory).st_mtime_ns
+            entries = list(os.scandir(directory))
+        except OSError:
+            return self.remove_dir(directory)
+
+        files = set()
+        subdirs = set()
+        for entry in entries:
+            try:
+                if entry.is_dir():
+                    if entry.name not in EXCLUDED_DIR_NAMES:
+                        subdirs.add(entry.name)
+                elif entry.is_file():
+                    files.add(entry.name)
+            except OSError:
+                continue
+
+        old_mtime, old_files, old_subdirs = self.dirs.get(directory, (None, set(), set()))
+        self.dirs[directory] = (mtime, files, subdirs)
+        changed = old_mtime is None
+        for name in files - old_files:
+            self.add_file(os.path.join(directory, name))
+            changed = True
+        for name in old_files - files:
+            self.files.pop(os.path.relpath(os.path.join(directory, name), self.root), None)
+            changed = True
+        for name in subdirs - old_subdirs:
+            self.refresh(os.path.join(directory, name))
+            changed = True
+        for name in old_subdirs - subdirs:
+            self.remove_dir(os.path.join(directory, name))
+            changed = True
+        return changed
+
+    def add_file(self, full_path):
+        relative_path = os.path.relpath(full_path, self.root)
+        if self.accepts(relative_path):
+            self.files[relative_path] = full_path
+
+    def remove_dir(self, directory):
+        removed = self.dirs.pop(directory, None)
+        if removed is None:
+            return False
+        _, files, subdirs = removed
+        for name in files:
+            self.files.pop(os.path.relpath(os.path.join(directory, name), self.root), None)
+        for name in subdirs:
+            self.remove_dir(os.path.join(directory, name))
+        return True
+
+    def poll(self):
+        changed = False
+        if self.root not in self.dirs and os.path.isdir(self.root):
+            # the folder was created after it was registered
+            return self.refresh(self.root)
+        for directory in list(self.dirs):
+            if directory not in self.dirs:
+                continue
+            try:
+                mtime = os.stat(directory).st_mtime_ns
+            except OSError:
+                mtime = None
+            if mtime != self.dirs[directory][0]:
+                changed = self.refresh(directory) or changed
+        return changed
+
+
+class FolderIndex:
+    """
+    The files of a folder name across all of its directories. Relative paths resolve to the first directory that
+    has them, like get_full_path does when probing the disk. Lookups read index without locking, it is replaced
+    as a whole after a change.
+    """
+
+    def __init__(self, folders, extensions):
+        self.roots = [RootIndex(x, extensions) for x in folders]
+        for root in self.roots:
+            root.scan()
+        self.update()
+
+    def update(self):
+        paths = {}
+        for root in self.roots:
+            for relative_path, full_path in root.files.items():
+                paths.setdefault(relative_path, full_path)
+        self.index = FilenameIndex(paths)
+
+    def refresh(self, directory):
+        changed = False
+        for root in self.roots:
+            if directory == root.root or directory.startswith(os.path.join(root.root, "")):
+                if any(x in EXCLUDED_DIR_NAMES for x in os.path.relpath(directory, root.root).split(os.sep)):
+                    continue
+                changed = root.refresh(directory) or changed
+        if changed:
+            self.update()
+
+    def poll(self):
+        changed = False
+        for root in self.roots:
+            changed = root.poll() or changed
+        if changed:
+            self.update()
+
+
+class FileIndexService(FileSystemEventHandler):
+    """
+    Keeps a FolderIndex per folder name up to date, indexes are built the first time a folder name is looked up
+    and rebuilt when its registered directories or extensions change.
+    """
+
+    def __init__(self, poll_interval=5.0, use_watchdog=True):
+        self.poll_interval = poll_interval
+        self.lock = threading.RLock()
+        self.indexes = {}
+        self.observer = None
+        self.watched = set()
+        if use_watchdog and Observer is not None:
+            self.observer = Observer()
+            self.observer.daemon = True
+            self.observer.start()
+            logging.info("Watching model folders for changes")
+        else:
+            threading.Thread(target=self.poll_loop, name="file_index_poll", daemon=True).start()
+            logging.info("Polling model folders for changes every {} seconds".format(poll_interval))
+
+    def get(self, folder_name, folders, extensions):
+        key = (tuple(folders), frozenset(extensions))
+        entry = self.indexes.get(folder_name, None)
+        if entry is not None and entry[0] == key and (self.observer is None or self.watched.issuperset(folders)):
+            return entry[1]
+        with self.lock:
+            entry = self.indexes.get(folder_name, None)
+            if entry is None or entry[0] != key:
+                entry = (key, FolderIndex(folders, extensions))
+                self.indexes[folder_name] = entry
+            if self.observer is not None:
+                for x in folders:
+                    if x not in self.watched and os.path.isdir(x):
+                        # also covers directories created after the index was built
+                        self.watch(x)
+                        entry[1].refresh(x)
+            return entry[1]
+
+    def watch(self, directory):
+        try:
+            self.observer.schedule(self, directory, recursive=True)
+            self.watched.add(directory)
+        except OSError as e:
+            logging.warning("Can't watch {}, changes to it won't be picked up: {}".format(directory, e))
+
+    def on_any_event(self, event):
+        # listing the directory the event happened in again handles every kind of event the same way
+        directories = set()
+        for path in (event.src_path, getattr(event, "dest_path", "")):
+            if path:
+                directories.add(os.path.dirname(path))
+                if event.is_directory:
+                    directories.add(path)
+        with self.lock:
+            for directory in directories:
+                for _, index in self.indexes.values():
+                    index.refresh(directory)
+
+    def poll_loop(self):
+        stop = threading.Event()
+        while not stop.wait(self.poll_interval):
+            with self.lock:
+                indexes = [x[1] for x in self.indexes.values()]
+            for index in indexes:
+                with self.lock:
+                    index.poll()
@@ -0,0 +1,89 @@
+"""
+JSON encoding used by the server. orjson is used when it is installed, the json module otherwise, set_backend
+switches between them. Both encode NumPy arrays and scalars, pydantic models, sets and anything with an encoder
+registered through register_encoder, named tuples are encoded as arrays with either.
+"""
+import json
+import logging
+
+import numpy as np
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    from pydantic import BaseModel
+except ImportError:
+    BaseModel = None
+
+ENCODERS = {}
+
+
+def register_encoder(cls, function):
+    """
+    function(value) turns instances of cls and its subclasses into something JSON serializable.
+    """
+    ENCODERS[cls] = function
+
+
+def default(value):
+    for cls in type(value).__mro__:
+        if cls in ENCODERS:
+            return ENCODERS[cls](value)
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, np.generic):
+        return value.item()
+    if BaseModel is not None and isinstance(value, BaseModel):
+        return value.model_dump(mode="json")
+    if isinstance(value, (set, frozenset, tuple)):
+        # tuples only get here as named tuples, like the records of the prompt queue
+        return list(value)
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def _dumps_json(value):
+    return json.dumps(value, default=default).encode("utf-8")
+
+
+def _dumps_orjson(value):
+    try:
+        return orjson.dumps(value, default=default, option=orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS)
+    except orjson.JSONEncodeError:
+        # integers beyond 64 bits, non contiguous arrays and the like
+        return _dumps_json(value)
+
+
+BACKENDS = {"json": (_dumps_json, json.loads)}
+if orjson is not None:
+    BACKENDS["orjson"] = (_dumps_orjson, orjson.loads)
+
+backend = None
+_dumps = None
+_loads = None
+
+
+def set_backend(name):
+    global backend, _dumps, _loads
+    if name not in BACKENDS:
+        raise ValueError("Unknown JSON backend {}, available: {}".format(name, ", ".join(BACKENDS)))
+    backend = name
+    _dumps, _loads = BACKENDS[name]
+    logging.debug("Using {} for JSON encoding".format(name))
+
+
+def dumps_bytes(value):
+    return _dumps(value)
+
+
+def dumps(value):
+    return _dumps(value).decode("utf-8")
+
+
+def loads(data):
+    return _loads(data)
+
+
+set_backend("orjson" if orjson is not None else "json")
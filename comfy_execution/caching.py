@@ -0,0 +1,390 @@
+import hashlib
+import json
+import logging
+import os
+import pickle
+import sqlite3
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+SIZE_ESTIMATORS = {}
+
+
+def register_size_estimator(cls, function):
+    """
+    Custom nodes returning their own types can tell the cache how many bytes an instance holds,
+    function(value) -> int is used for instances of cls and its subclasses.
+    """
+    SIZE_ESTIMATORS[cls] = function
+
+
+def estimate_size(value, seen=None):
+    # approximate number of bytes kept alive by value, objects reachable twice are only counted once
+    if seen is None:
+        seen = set()
+    if id(value) in seen:
+        return 0
+    seen.add(id(value))
+
+    for cls in type(value).__mro__:
+        if cls in SIZE_ESTIMATORS:
+            return SIZE_ESTIMATORS[cls](value)
+
+    nbytes = getattr(value, "nbytes", None)
+    if isinstance(nbytes, int):
+        # numpy arrays and anything array-like
+        return nbytes
+
+    size = sys.getsizeof(value)
+    if isinstance(value, (str, bytes, bytearray, int, float, bool)) or value is None:
+        return size
+    if isinstance(value, dict):
+        for k, v in value.items():
+            size += estimate_size(k, seen) + estimate_size(v, seen)
+    elif isinstance(value, (list, tuple, set, frozenset)):
+        for v in value:
+            size += estimate_size(v, seen)
+    elif hasattr(value, "__dict__"):
+        size += estimate_size(vars(value), seen)
+    return size
+
+
+class UncacheableValue(Exception):
+    pass
+
+
+def _raise_uncacheable(value):
+    raise UncacheableValue(type(value).__name__)
+
+
+def node_signature(class_type, inputs, input_signatures, is_changed, unique_id=None):
+    """
+    Hash identifying the result of a node independently of its id in the prompt.
+
+    inputs           - the node's inputs from the prompt, links are replaced by the signature of the linked node
+    input_signatures - signature of each linked node id
+    is_changed       - result of IS_CHANGED, '' when the node doesn't define it
+    unique_id        - only for nodes that take their UNIQUE_ID as input
+
+    Returns None when the result can't be reused: an input isn't cacheable, or is_changed holds something that
+    doesn't compare equal to itself (NaN is the usual way of forcing a node to always execute).
+    """
+    signed_inputs = {}
+    for x, input_data in inputs.items():
+        if isinstance(input_data, list) and len(input_data) == 2 and input_data[0] in input_signatures:
+            input_signature = input_signatures[input_data[0]]
+            if input_signature is None:
+                return None
+            signed_inputs[x] = {"link": input_signature, "index": input_data[1]}
+        else:
+            signed_inputs[x] = {"value": input_data}
+
+    try:
+        data = json.dumps([class_type, signed_inputs, is_changed, unique_id], sort_keys=True, allow_nan=False,
+                          default=_raise_uncacheable)
+    except (ValueError, TypeError, UncacheableValue):
+        return None
+    return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+
+class CacheEntry:
+    def __init__(self, output, ui, size):
+        self.output = output
+        self.ui = ui
+        self.size = size
+
+
+class SpillStore:
+    """
+    Disk tier for results evicted from memory. Only results made of NumPy arrays and bytes are spilled,
+    arrays come back as copy-on-write memory maps of the spill file so reading them doesn't copy anything.
+    Files are dropped in least recently used order past max_bytes.
+    """
+
+    def __init__(self, directory, max_bytes, min_size=1024 * 1024):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.min_size = min_size
+        self.entries = OrderedDict()
+        self.size = 0
+
+    def can_spill(self, entry):
+        if entry.size < self.min_size:
+            return False
+        for values in entry.output:
+            for value in values:
+                if isinstance(value, np.ndarray):
+                    if value.dtype.hasobject:
+                        return False
+                elif not isinstance(value, (bytes, bytearray)):
+                    return False
+        return True
+
+    def spill(self, signature, entry):
+        os.makedirs(self.directory, exist_ok=True)
+        files = []
+        size = 0
+        try:
+            for i, values in enumerate(entry.output):
+                files.append([])
+                for j, value in enumerate(values):
+                    path = os.path.join(self.directory, "{}_{}_{}".format(signature, i, j))
+                    if isinstance(value, np.ndarray):
+                        path += ".npy"
+                        np.save(path, value, allow_pickle=False)
+                    else:
+                        with open(path, "wb") as f:
+                            f.write(value)
+                    files[-1].append(path)
+                    size += os.path.getsize(path)
+        except OSError as e:
+            logging.warning("Failed to spill cached output to {}: {}".format(self.directory, e))
+            self._delete_files(files)
+            return
+
+        self.remove(signature)
+        self.entries[signature] = (files, entry.ui, size)
+        self.size += size
+        while self.size > self.max_bytes and len(self.entries) > 0:
+            self.remove(next(iter(self.entries)))
+
+    def load(self, signature):
+        if signature not in self.entries:
+            return None
+        files, ui, size = self.entries[signature]
+        self.entries.move_to_end(signature)
+        output = []
+        try:
+            for paths in files:
+                values = []
+                for path in paths:
+                    if path.endswith(".npy"):
+                        values.append(np.load(path, mmap_mode="c", allow_pickle=False))
+                    else:
+                        with open(path, "rb") as f:
+                            values.append(f.read())
+                output.append(values)
+        except OSError as e:
+            logging.warning("Failed to read spilled output {}: {}".format(signature, e))
+            self.remove(signature)
+            return None
+        return CacheEntry(output, ui, 0)
+
+    def remove(self, signature):
+        spilled = self.entries.pop(signature, None)
+        if spilled is not None:
+            self.size -= spilled[2]
+            self._delete_files(spilled[0])
+
+    def clear(self):
+        for signature in list(self.entries):
+            self.remove(signature)
+
+    def _delete_files(self, files):
+        for paths in files:
+            for path in paths:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+
+
+def persistent_cache_ttl(class_def):
+    """
+    Nodes opt into the persistent cache with DETERMINISTIC = True (kept forever) or CACHE_TTL = seconds.
+    Returns None for nodes that didn't, 0 for results that never expire.
+    """
+    ttl = getattr(class_def, "CACHE_TTL", None)
+    if ttl is None and getattr(class_def, "DETERMINISTIC", False) is True:
+        return 0
+    return ttl
+
+
+class PersistentStore:
+    """
+    SQLite store for the results of nodes that opted in with persistent_cache_ttl, it survives restarts and is
+    shared by every process using the same file (WAL mode lets them read while one writes).
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.connection = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        with self.connection:
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute("CREATE TABLE IF NOT EXISTS results "
+                                    "(signature TEXT PRIMARY KEY, expires REAL, data BLOB NOT NULL)")
+        self.purge_expired()
+
+    def load(self, signature):
+        with self.lock:
+            row = self.connection.execute("SELECT data, expires FROM results WHERE signature = ?",
+                                          (signature,)).fetchone()
+        if row is None:
+            return None
+        data, expires = row
+        if expires is not None and expires < time.time():
+            self.remove(signature)
+            return None
+        try:
+            output, ui = pickle.loads(data)
+        except Exception as e:
+            logging.warning("Dropping unreadable persistent cache entry {}: {}".format(signature, e))
+            self.remove(signature)
+            return None
+        return CacheEntry(output, ui, 0)
+
+    def store(self, signature, entry, ttl):
+        try:
+            data = pickle.dumps((entry.output, entry.ui), protocol=pickle.HIGHEST_PROTOCOL)
+        except Exception as e:
+            logging.debug("Result {} can't be persisted: {}".format(signature, e))
+            return
+        expires = time.time() + ttl if ttl else None
+        with self.lock, self.connection:
+            self.connection.execute("INSERT OR REPLACE INTO results (signature, expires, data) VALUES (?, ?, ?)",
+                                    (signature, expires, data))
+
+    def remove(self, signature):
+        with self.lock, self.connection:
+            self.connection.execute("DELETE FROM results WHERE signature = ?", (signature,))
+
+    def purge_expired(self):
+        with self.lock, self.connection:
+            self.connection.execute("DELETE FROM results WHERE expires IS NOT NULL AND expires < ?", (time.time(),))
+
+    def __len__(self):
+        with self.lock:
+            return self.connection.execute("SELECT COUNT(*) FROM results").fetchone()[0]
+
+
+class OutputCache:
+    """
+    Node results shared between prompts, keyed by node_signature.
+
+    The entries used by the latest prompt are kept so re-running it costs nothing, on top of them up to
+    max_entries results of earlier prompts are kept in least recently used order. When max_bytes is set the
+    least recently used entries are dropped, pinned or not, until the estimated size of all entries fits,
+    a dropped result is simply computed again the next time a prompt needs it. With a spill store, evicted
+    entries that it accepts move there instead of being dropped. A persistent store is only consulted and
+    written for the nodes the caller marks as persistent.
+    """
+
+    def __init__(self, max_entries=0, max_bytes=None, spill=None, persistent=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.spill = spill
+        self.persistent = persistent
+        self.entries = OrderedDict()
+        self.pinned = set()
+        self.size = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.spill_hits = 0
+        self.persistent_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, signature, persistent=False):
+        with self.lock:
+            entry = self.entries.get(signature, None)
+            if entry is None and self.spill is not None:
+                entry = self.spill.load(signature)
+                if entry is not None:
+                    self.spill_hits += 1
+                    return entry
+            if entry is not None:
+                self.entries.move_to_end(signature)
+                self.hits += 1
+                return entry
+
+        if persistent and self.persistent is not None:
+            entry = self.persistent.load(signature)
+            if entry is not None:
+                self.set(signature, entry.output, entry.ui)
+                with self.lock:
+                    self.persistent_hits += 1
+                return entry
+
+        with self.lock:
+            self.misses += 1
+        return None
+
+    def set(self, signature, output, ui, persistent_ttl=None):
+        # persistent_ttl is None for nodes that aren't persisted, 0 when their result never expires
+        if persistent_ttl is not None and self.persistent is not None:
+            self.persistent.store(signature, CacheEntry(output, ui, 0), persistent_ttl)
+
+        size = estimate_size(output) + estimate_size(ui)
+        with self.lock:
+            self._remove(signature)
+            if self.spill is not None:
+                self.spill.remove(signature)
+            self.entries[signature] = CacheEntry(output, ui, size)
+            self.size += size
+            self._evict_bytes()
+
+    def pin(self, signatures):
+        # the entries of the running prompt, only evicted to stay within max_bytes
+        with self.lock:
+            self.pinned = set(signatures)
+
+    def evict(self):
+        with self.lock:
+            unpinned = len([x for x in self.entries if x not in self.pinned])
+            for signature in list(self.entries):
+                if unpinned <= self.max_entries:
+                    break
+                if signature in self.pinned:
+                    continue
+                self._evict(signature)
+                unpinned -= 1
+            self._evict_bytes()
+
+    def _evict_bytes(self):
+        if self.max_bytes is None:
+            return
+        while self.size > self.max_bytes and len(self.entries) > 0:
+            self._evict(next(iter(self.entries)))
+
+    def _evict(self, signature):
+        entry = self._remove(signature)
+        self.evictions += 1
+        if self.spill is not None and self.spill.can_spill(entry):
+            self.spill.spill(signature, entry)
+
+    def _remove(self, signature):
+        entry = self.entries.pop(signature, None)
+        if entry is not None:
+            self.size -= entry.size
+        return entry
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.pinned = set()
+            self.size = 0
+            if self.spill is not None:
+                self.spill.clear()
+
+    def stats(self):
+        with self.lock:
+            return {
+                "entries": len(self.entries),
+                "max_entries": self.max_entries,
+                "bytes": self.size,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "spilled_entries": len(self.spill.entries) if self.spill is not None else 0,
+                "spilled_bytes": self.spill.size if self.spill is not None else 0,
+                "spill_hits": self.spill_hits,
+                "persistent_entries": len(self.persistent) if self.persistent is not None else 0,
+                "persistent_hits": self.persistent_hits,
+            }
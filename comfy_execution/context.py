@@ -0,0 +1,37 @@
+import threading
+
+_current = threading.local()
+
+
+class ExecutionContext:
+    """
+    Where the events of one prompt execution go: the prompt, the client that queued it and the node being executed.
+    Every running node gets its own context through for_node, and the one of the node running on a thread is
+    available from get_current_context, so the progress hook and custom nodes report to the right client even
+    while several prompts or nodes execute at once.
+    """
+
+    def __init__(self, server, prompt_id, client_id=None, node_id=None):
+        self.server = server
+        self.prompt_id = prompt_id
+        self.client_id = client_id
+        self.node_id = node_id
+
+    def for_node(self, node_id):
+        return ExecutionContext(self.server, self.prompt_id, self.client_id, node_id)
+
+    def send_sync(self, event, data, broadcast=False):
+        # events of prompts queued without a client_id are dropped unless broadcast
+        if self.client_id is not None or broadcast:
+            self.server.send_sync(event, data, self.client_id)
+
+
+def get_current_context():
+    return getattr(_current, "context", None)
+
+
+def set_current_context(context):
+    # returns the context it replaces so callers can put it back
+    previous = getattr(_current, "context", None)
+    _current.context = context
+    return previous
@@ -0,0 +1,160 @@
+import math
+from collections import deque
+
+from comfy_execution.prompt_heap import PromptHeap
+
+# what tenant_of can share by: the client that queued a prompt, or the user, which the server records when
+# scheduling by user
+TENANT_KEYS = {
+    "client": lambda record: record[3].get("client_id", None),
+    "user": lambda record: record[3].get("user_id", None),
+}
+
+
+class FairShareQueue:
+    """
+    Pending prompts in a PromptHeap per tenant (a client or user, whatever tenant_of returns for a record), taken
+    in deficit round robin: each turn a tenant may start as many prompts as its weight (1 unless set in weights,
+    which must be positive, fractions accumulate over turns), so a tenant with thousands of queued prompts only
+    delays the others by its share. Numbers and "front" order prompts within a tenant. With max_running set a
+    tenant never has more than that many prompts running, the others get the free executors meanwhile.
+
+    Has the interface of PromptHeap that PromptQueue uses, iteration goes tenant by tenant.
+    """
+
+    def __init__(self, tenant_of, weights=None, max_running=0):
+        self.tenant_of = tenant_of
+        self.weights = weights or {}
+        self.max_running = max_running
+        self.queues = {}
+        # prompt_id -> tenant of the pending prompts
+        self.tenants = {}
+        # tenants with pending prompts in round robin order, the first one has its turn
+        self.active = deque()
+        self.deficit = {}
+        # whether the first tenant in active has been credited its weight for its turn
+        self.credited = False
+        self.running = {}
+
+    def __len__(self):
+        return len(self.tenants)
+
+    def __contains__(self, prompt_id):
+        return prompt_id in self.tenants
+
+    def __iter__(self):
+        for queue in list(self.queues.values()):
+            yield from queue
+
+    def weight(self, tenant):
+        return self.weights.get(tenant, 1)
+
+    def can_run(self, tenant):
+        return self.max_running <= 0 or self.running.get(tenant, 0) < self.max_running
+
+    def ready(self):
+        # whether pop has a prompt to return, prompts of tenants at their limit wait
+        return any(self.can_run(x) for x in self.active)
+
+    def get(self, prompt_id):
+        # prompts queued without a client or user share the tenant None
+        if prompt_id not in self.tenants:
+            return None
+        return self.queues[self.tenants[prompt_id]].get(prompt_id)
+
+    def first(self):
+        return min(x.first() for x in self.queues.values())
+
+    def clear(self):
+        # running counts stay, those prompts are still running
+        self.queues = {}
+        self.tenants = {}
+        self.active.clear()
+        self.deficit = {}
+        self.credited = False
+
+    def push(self, item):
+        if item[1] in self.tenants:
+            self.replace(item)
+            return
+        tenant = self.tenant_of(item)
+        if tenant not in self.queues:
+            self.queues[tenant] = PromptHeap()
+            self.deficit[tenant] = 0
+            self.active.append(tenant)
+        self.queues[tenant].push(item)
+        self.tenants[item[1]] = tenant
+
+    def replace(self, item):
+        self.queues[self.tenants[item[1]]].replace(item)
+
+    def remove(self, prompt_id):
+        if prompt_id not in self.tenants:
+            return None
+        tenant = self.tenants.pop(prompt_id)
+        item = self.queues[tenant].remove(prompt_id)
+        if len(self.queues[tenant]) == 0:
+            if self.active[0] == tenant:
+                # the next tenant starts a turn of its own
+                self.credited = False
+            self.active.remove(tenant)
+            self.drop(tenant)
+        return item
+
+    def drop(self, tenant):
+        # a tenant without pending prompts leaves the rotation and loses what it had not used of its turns
+        del self.queues[tenant]
+        del self.deficit[tenant]
+
+    def pop(self):
+        # only call when ready()
+        misses = 0
+        while True:
+            tenant = self.active[0]
+            if not self.credited and misses >= len(self.active):
+                # a whole round went by without a tenant reaching 1, skip the rounds it takes one to get there
+                # rather than going around 1 / weight times
+                self.skip_rounds()
+                misses = 0
+            if not self.credited:
+                # ones at their limit don't build up credit while they wait
+                self.credited = True
+                if self.can_run(tenant):
+                    self.deficit[tenant] += self.weight(tenant)
+            if self.deficit[tenant] >= 1 and self.can_run(tenant):
+                self.deficit[tenant] -= 1
+                item = self.queues[tenant].pop()
+                del self.tenants[item[1]]
+                if len(self.queues[tenant]) == 0:
+                    self.active.popleft()
+                    self.drop(tenant)
+                    self.credited = False
+                self.running[tenant] = self.running.get(tenant, 0) + 1
+                return item
+            self.active.rotate(-1)
+            self.credited = False
+            misses += 1
+
+    def skip_rounds(self):
+        runnable = [x for x in self.active if self.can_run(x)]
+        rounds = min(max(1, math.ceil((1 - self.deficit[x]) / self.weight(x))) for x in runnable) - 1
+        for x in runnable:
+            self.deficit[x] += rounds * self.weight(x)
+
+    def task_done(self, item):
+        tenant = self.tenant_of(item)
+        if self.running.get(tenant, 0) > 1:
+            self.running[tenant] -= 1
+        else:
+            self.running.pop(tenant, None)
+
+    def stats(self):
+        tenants = {}
+        for tenant in set(self.queues) | set(self.running):
+            tenants[str(tenant)] = {
+                "pending": len(self.queues[tenant]) if tenant in self.queues else 0,
+                "running": self.running.get(tenant, 0),
+                "weight": self.weight(tenant),
+            }
+        return {"pending": len(self), "running": sum(self.running.values()), "max_running": self.max_running,
+                "tenants": tenants}
@@ -0,0 +1,174 @@
+import heapq
+from collections import deque
+
+
+class DependencyCycleError(Exception):
+    def __init__(self, node_ids):
+        super().__init__("Dependency cycle between nodes {}".format(", ".join(map(str, node_ids))))
+        self.node_ids = node_ids
+
+
+def get_input_links(node):
+    # yields (input_name, input_unique_id, output_index) for every linked input of a prompt node
+    for x, input_data in node.get('inputs', {}).items():
+        if isinstance(input_data, list) and len(input_data) == 2:
+            yield x, input_data[0], input_data[1]
+
+
+class PromptGraph:
+    """
+    Dependency graph of a prompt, compiled once so the executor never has to recurse over the links.
+
+    upstream[x]   - distinct node ids linked into the inputs of x
+    downstream[x] - distinct node ids that x is linked into
+    in_degree[x]  - len(upstream[x])
+    order         - topological order of every node, inputs always come before the nodes that use them
+    """
+
+    def __init__(self, prompt):
+        self.prompt = prompt
+        self.upstream = {}
+        self.downstream = {}
+        for unique_id in prompt:
+            self.upstream[unique_id] = []
+            self.downstream[unique_id] = []
+
+        for unique_id in prompt:
+            upstream = self.upstream[unique_id]
+            for _, input_unique_id, _ in get_input_links(prompt[unique_id]):
+                # links to nodes missing from the prompt are left to get_input_data, which feeds None
+                if input_unique_id in prompt and input_unique_id not in upstream:
+                    upstream.append(input_unique_id)
+                    self.downstream[input_unique_id].append(unique_id)
+
+        self.in_degree = {unique_id: len(upstream) for unique_id, upstream in self.upstream.items()}
+
+        remaining = dict(self.in_degree)
+        ready = deque(unique_id for unique_id in prompt if remaining[unique_id] == 0)
+        self.order = []
+        while len(ready) > 0:
+            unique_id = ready.popleft()
+            self.order.append(unique_id)
+            for x in self.downstream[unique_id]:
+                remaining[x] -= 1
+                if remaining[x] == 0:
+                    ready.append(x)
+
+        if len(self.order) != len(prompt):
+            raise DependencyCycleError(self._cycle_nodes(x for x in prompt if remaining[x] > 0))
+
+    def _cycle_nodes(self, unsorted):
+        # peel off the nodes that merely depend on a cycle, leaving the ones on it
+        unsorted = set(unsorted)
+        out_degree = {x: sum(1 for y in self.downstream[x] if y in unsorted) for x in unsorted}
+        leaves = [x for x in unsorted if out_degree[x] == 0]
+        while len(leaves) > 0:
+            unique_id = leaves.pop()
+            unsorted.discard(unique_id)
+            for x in self.upstream[unique_id]:
+                if x in unsorted:
+                    out_degree[x] -= 1
+                    if out_degree[x] == 0:
+                        leaves.append(x)
+        return [x for x in self.prompt if x in unsorted]
+
+    def pending(self, node_ids, outputs):
+        """
+        Returns the nodes that have to run to produce node_ids, in topological order.
+        Nodes present in outputs are treated as done and their inputs are not visited.
+        """
+        visited = set()
+        result = []
+        for node_id in node_ids:
+            if node_id in visited or node_id in outputs:
+                continue
+            visited.add(node_id)
+            # iterative post-order walk, a node is emitted once all of its inputs have been
+            stack = [(node_id, iter(self.upstream[node_id]))]
+            while len(stack) > 0:
+                unique_id, inputs = stack[-1]
+                for input_unique_id in inputs:
+                    if input_unique_id not in visited and input_unique_id not in outputs:
+                        visited.add(input_unique_id)
+                        stack.append((input_unique_id, iter(self.upstream[input_unique_id])))
+                        break
+                else:
+                    stack.pop()
+                    result.append(unique_id)
+        return result
+
+
+class OutputScheduler:
+    """
+    Hands out output nodes in the order the executor runs them: the output that depends on the least amount of
+    unexecuted nodes first, ties broken by node id. Dependencies are counted the way recursive_will_execute did,
+    once per path: a node counts itself plus, for every input linked to an unexecuted node, the count of that
+    node. The counts are computed once, and after an output ran only the nodes downstream of what it executed are
+    counted again, instead of re-sorting every output after each one.
+    """
+
+    def __init__(self, graph, output_node_ids, outputs):
+        self.graph = graph
+        self.position = {x: i for i, x in enumerate(graph.order)}
+        self.executed = set()
+        self.remaining = {}
+        self.heap = []
+        nodes = graph.pending(list(dict.fromkeys(output_node_ids)), outputs)
+        # per linked input, so a node linked into two inputs counts twice like before
+        self.links = {}
+        for unique_id in nodes:
+            self.links[unique_id] = [x for _, x, _ in get_input_links(graph.prompt[unique_id])
+                                     if x in graph.prompt and x not in outputs]
+        self.counts = {}
+        for unique_id in nodes:
+            self.count(unique_id)
+        for node_id in output_node_ids:
+            if node_id not in self.remaining:
+                self.remaining[node_id] = self.counts.get(node_id, 0)
+                self.heap.append((self.remaining[node_id], node_id))
+        heapq.heapify(self.heap)
+
+    def count(self, unique_id):
+        # with the counts of its inputs up to date
+        self.counts[unique_id] = 1 + sum(self.counts[x] for x in self.links[unique_id] if x not in self.executed)
+
+    def __len__(self):
+        return len(self.remaining)
+
+    def pop(self):
+        # entries are pushed again whenever a count drops, skip the ones that are out of date
+        while len(self.heap) > 0:
+            count, node_id = heapq.heappop(self.heap)
+            if self.remaining.get(node_id) == count:
+                del self.remaining[node_id]
+                return node_id
+        return None
+
+    def done(self, node_id):
+        # every node the output was waiting on has executed now
+        if node_id not in self.counts or node_id in self.executed:
+            return
+        ran = []
+        stack = [node_id]
+        self.executed.add(node_id)
+        while len(stack) > 0:
+            unique_id = stack.pop()
+            ran.append(unique_id)
+            for x in self.links[unique_id]:
+                if x not in self.executed:
+                    self.executed.add(x)
+                    stack.append(x)
+
+        changed = set()
+        stack = [x for unique_id in ran for x in self.graph.downstream[unique_id]]
+        while len(stack) > 0:
+            unique_id = stack.pop()
+            if unique_id in changed or unique_id in self.executed or unique_id not in self.counts:
+                continue
+            changed.add(unique_id)
+            stack.extend(self.graph.downstream[unique_id])
+        for unique_id in sorted(changed, key=self.position.__getitem__):
+            self.count(unique_id)
+            if unique_id in self.remaining:
+                self.remaining[unique_id] = self.counts[unique_id]
+                heapq.heappush(self.heap, (self.counts[unique_id], unique_id))
@@ -0,0 +1,176 @@
+from bisect import bisect_left, bisect_right
+
+from comfy_execution.caching import estimate_size
+
+
+class SeqList:
+    """
+    Ascending history indexes. Removing from the front only moves head, the list is compacted once most of it is
+    dead, so appending and evicting are O(1) amortized and positions are plain arithmetic.
+    """
+
+    def __init__(self):
+        self.seqs = []
+        self.head = 0
+
+    def __len__(self):
+        return len(self.seqs) - self.head
+
+    def append(self, seq):
+        self.seqs.append(seq)
+
+    def popleft(self):
+        seq = self.seqs[self.head]
+        self.head += 1
+        if self.head > 64 and self.head * 2 > len(self.seqs):
+            del self.seqs[:self.head]
+            self.head = 0
+        return seq
+
+    def first(self):
+        return self.seqs[self.head]
+
+    def remove(self, seq):
+        # O(n), only for explicit deletes
+        i = bisect_left(self.seqs, seq, self.head)
+        if i < len(self.seqs) and self.seqs[i] == seq:
+            del self.seqs[i]
+
+    def range(self, start, stop):
+        # seqs at positions [start, stop)
+        start = max(start, 0)
+        stop = min(stop, len(self))
+        return self.seqs[self.head + start:self.head + stop] if start < stop else []
+
+    def position(self, seq, after):
+        # number of seqs < seq, or <= seq when after, found by bisection
+        if after:
+            return bisect_right(self.seqs, seq, self.head) - self.head
+        return bisect_left(self.seqs, seq, self.head) - self.head
+
+
+class HistoryStore:
+    """
+    Finished prompts by prompt_id in the order they finished. Every entry gets an increasing "index" that stays valid
+    as a pagination cursor after older entries are evicted. The order of all entries and of the entries of each
+    client and each status are kept in SeqLists, so appending, evicting the oldest and finding a page by offset or
+    cursor never walk the history. The oldest entries are evicted once there are more than max_items, or their
+    estimated size exceeds max_bytes. Not thread safe, PromptQueue calls it with its mutex held.
+    """
+
+    def __init__(self, max_items=None, max_bytes=None):
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self.clear()
+
+    def clear(self):
+        # prompt_id -> (seq, entry, size, client_id, status)
+        self.entries = {}
+        self.by_seq = {}
+        self.order = SeqList()
+        self.by_client = {}
+        self.by_status = {}
+        self.next_seq = 0
+        self.bytes = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, prompt_id):
+        return prompt_id in self.entries
+
+    def get(self, prompt_id):
+        record = self.entries.get(prompt_id, None)
+        return None if record is None else record[1]
+
+    def add(self, prompt_id, entry, client_id=None, status=None, size=None):
+        """
+        Adds entry, a dict the store adds "index" to, and evicts what no longer fits, returning the prompt ids of the
+        evicted entries. size is the estimated size in bytes, callers can estimate it before taking a lock. Entries
+        that already have an index keep it, for restoring a saved history in order.
+        """
+        self.remove(prompt_id)
+        seq = entry.get("index", None)
+        if seq is None or seq < self.next_seq:
+            seq = self.next_seq
+        self.next_seq = seq + 1
+        entry["index"] = seq
+        if size is None:
+            size = estimate_size(entry)
+        self.entries[prompt_id] = (seq, entry, size, client_id, status)
+        self.by_seq[seq] = prompt_id
+        self.order.append(seq)
+        self.by_client.setdefault(client_id, SeqList()).append(seq)
+        self.by_status.setdefault(status, SeqList()).append(seq)
+        self.bytes += size
+        return self.evict()
+
+    def evict(self):
+        # the newest entry stays even when it is larger than max_bytes on its own
+        evicted = []
+        while len(self.order) > 1 and ((self.max_items is not None and len(self.order) > self.max_items) or
+                                       (self.max_bytes is not None and self.bytes > self.max_bytes)):
+            evicted.append(self.by_seq[self.order.first()])
+            self.drop(evicted[-1])
+        return evicted
+
+    def drop(self, prompt_id):
+        seq, _, size, client_id, status = self.entries.pop(prompt_id)
+        del self.by_seq[seq]
+        self.bytes -= size
+        for lists, key in ((self.by_client, client_id), (self.by_status, status)):
+            seqs = lists[key]
+            if len(seqs) > 0 and seqs.first() == seq:
+                seqs.popleft()
+            else:
+                seqs.remove(seq)
+            if len(seqs) == 0:
+                del lists[key]
+        if len(self.order) > 0 and self.order.first() == seq:
+            self.order.popleft()
+        else:
+            self.order.remove(seq)
+
+    def remove(self, prompt_id):
+        if prompt_id in self.entries:
+            self.drop(prompt_id)
+
+    def page(self, max_items=None, offset=-1, before=None, after=None, client_id=None, status=None):
+        """
+        Entries as {prompt_id: entry}, oldest first. With client_id or status only the entries of that client or
+        status are considered, with both the page of the client is filtered by status and may come out shorter.
+        Without a cursor the page starts at offset, a negative offset means the newest max_items. before returns
+        the newest max_items entries with an index lower than before, after the oldest ones with an index higher
+        than after.
+        """
+        if client_id is not None:
+            seqs = self.by_client.get(client_id, SeqList())
+        elif status is not None:
+            seqs = self.by_status.get(status, SeqList())
+        else:
+            seqs = self.order
+
+        if after is not None:
+            start = seqs.position(after, True)
+            stop = len(seqs) if max_items is None else start + max_items
+        elif before is not None:
+            stop = seqs.position(before, False)
+            start = 0 if max_items is None else stop - max_items
+        else:
+            if offset < 0 and max_items is not None:
+                offset = len(seqs) - max_items
+            start = max(offset, 0)
+            stop = len(seqs) if max_items is None else start + max_items
+
+        out = {}
+        for seq in seqs.range(start, stop):
+            prompt_id = self.by_seq[seq]
+            record = self.entries[prompt_id]
+            if status is not None and record[4] != status:
+                continue
+            out[prompt_id] = record[1]
+        return out
+
+    def stats(self):
+        return {"entries": len(self.entries), "max_items": self.max_items, "bytes": self.bytes,
+                "max_bytes": self.max_bytes}
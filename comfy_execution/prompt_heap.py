@@ -0,0 +1,103 @@
+class PromptHeap:
+    """
+    Binary min-heap of queue records ordered like tuples, that also keeps the position of every record by
+    prompt_id (record[1]). Removing or replacing a record anywhere in the heap only sifts it into place, O(log n),
+    instead of searching for it and heapifying again.
+    """
+
+    def __init__(self):
+        self.items = []
+        self.positions = {}
+
+    def __len__(self):
+        return len(self.items)
+
+    def __contains__(self, prompt_id):
+        return prompt_id in self.positions
+
+    def __iter__(self):
+        # heap order, not sorted
+        return iter(self.items)
+
+    def get(self, prompt_id):
+        i = self.positions.get(prompt_id, None)
+        return None if i is None else self.items[i]
+
+    def first(self):
+        return self.items[0]
+
+    def ready(self):
+        return len(self.items) > 0
+
+    def task_done(self, item):
+        # PromptQueue reports finished prompts to its pending queue, a plain heap doesn't limit what runs
+        pass
+
+    def stats(self):
+        return {"pending": len(self.items)}
+
+    def clear(self):
+        self.items = []
+        self.positions = {}
+
+    def push(self, item):
+        if item[1] in self.positions:
+            self.replace(item)
+            return
+        self.items.append(item)
+        self.positions[item[1]] = len(self.items) - 1
+        self.sift_up(len(self.items) - 1)
+
+    def pop(self):
+        return self.remove_at(0)
+
+    def remove(self, prompt_id):
+        # the removed record, None when prompt_id isn't queued
+        i = self.positions.get(prompt_id, None)
+        return None if i is None else self.remove_at(i)
+
+    def replace(self, item):
+        # puts item in place of the record with the same prompt_id, for changing its priority
+        i = self.positions[item[1]]
+        self.items[i] = item
+        self.sift_up(i)
+        self.sift_down(self.positions[item[1]])
+
+    def remove_at(self, i):
+        item = self.items[i]
+        last = self.items.pop()
+        del self.positions[item[1]]
+        if i < len(self.items):
+            self.items[i] = last
+            self.positions[last[1]] = i
+            self.sift_up(i)
+            self.sift_down(self.positions[last[1]])
+        return item
+
+    def swap(self, i, j):
+        items = self.items
+        items[i], items[j] = items[j], items[i]
+        self.positions[items[i][1]] = i
+        self.positions[items[j][1]] = j
+
+    def sift_up(self, i):
+        items = self.items
+        while i > 0:
+            parent = (i - 1) // 2
+            if not items[i] < items[parent]:
+                break
+            self.swap(i, parent)
+            i = parent
+
+    def sift_down(self, i):
+        items = self.items
+        n = len(items)
+        while True:
+            smallest = i
+            for child in (2 * i + 1, 2 * i + 2):
+                if child < n and items[child] < items[smallest]:
+                    smallest = child
+            if smallest == i:
+                break
+            self.swap(i, smallest)
+            i = smallest
@@ -0,0 +1,209 @@
+import logging
+import os
+import pickle
+import sqlite3
+import threading
+import time
+
+
+class QueueStore:
+    """
+    Where PromptQueue saves its pending prompts and history so they survive a restart. The queue keeps working from
+    memory and calls the store with its mutex held after every change, so a store only records the change there and
+    writes it out elsewhere. This one keeps nothing.
+    """
+
+    def load(self):
+        # (pending records, history as (prompt_id, entry, client_id, status, size) in order)
+        return [], []
+
+    def start_sync(self):
+        pass
+
+    def put(self, item):
+        pass
+
+    def start(self, item):
+        pass
+
+    def done(self, prompt_id, entry, client_id, status, size):
+        pass
+
+    def remove_pending(self, prompt_ids):
+        pass
+
+    def clear_pending(self):
+        pass
+
+    def remove_history(self, prompt_ids):
+        pass
+
+    def clear_history(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class SQLiteQueueStore(QueueStore):
+    """
+    Journals the queue to an SQLite file in WAL mode. Changes are collected in memory and written by a thread of
+    its own, started by start_sync, in one transaction every sync_interval seconds, so there is one fsync per batch rather than one per
+    change, and a crash loses at most the changes of the last interval. Records and entries are pickled by that
+    thread, the queue never modifies them after handing them over. Prompts that were running when the process
+    stopped are pending again after a restart.
+    """
+
+    def __init__(self, path, sync_interval=0.2):
+        self.path = path
+        self.sync_interval = sync_interval
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.connection = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        with self.connection:
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute("PRAGMA synchronous=FULL")
+            self.connection.execute("CREATE TABLE IF NOT EXISTS pending "
+                                    "(prompt_id TEXT PRIMARY KEY, number REAL, running INTEGER, record BLOB)")
+            self.connection.execute("CREATE TABLE IF NOT EXISTS history (prompt_id TEXT PRIMARY KEY, "
+                                    "seq INTEGER, client_id TEXT, status TEXT, size INTEGER, entry BLOB)")
+        # lock guards changes, write_lock the connection, so recording never waits for a write
+        self.lock = threading.Condition()
+        self.write_lock = threading.Lock()
+        self.changes = []
+        self.closed = False
+        self.thread = None
+
+    def start_sync(self):
+        # changes recorded until then are written with the first batch
+        self.thread = threading.Thread(target=self.sync_loop, name="queue_store", daemon=True)
+        self.thread.start()
+
+    def load(self):
+        pending = []
+        history = []
+        with self.write_lock:
+            with self.connection:
+                # prompts that were running are queued again
+                self.connection.execute("UPDATE pending SET running = 0")
+            rows = self.connection.execute("SELECT prompt_id, record FROM pending ORDER BY number").fetchall()
+            history_rows = self.connection.execute("SELECT prompt_id, client_id, status, size, entry FROM history "
+                                                   "ORDER BY seq").fetchall()
+        for prompt_id, data in rows:
+            try:
+                pending.append(pickle.loads(data))
+            except Exception as e:
+                logging.warning("Dropping unreadable queued prompt {}: {}".format(prompt_id, e))
+                self.remove_pending([prompt_id])
+        for prompt_id, client_id, status, size, data in history_rows:
+            try:
+                history.append((prompt_id, pickle.loads(data), client_id, status, size))
+            except Exception as e:
+                logging.warning("Dropping unreadable history entry {}: {}".format(prompt_id, e))
+                self.remove_history([prompt_id])
+        return pending, history
+
+    def record(self, *change):
+        with self.lock:
+            self.changes.append(change)
+            self.lock.notify()
+
+    def put(self, item):
+        self.record("put", item)
+
+    def start(self, item):
+        self.record("start", item[1])
+
+    def done(self, prompt_id, entry, client_id, status, size):
+        self.record("done", prompt_id, entry, client_id, status, size)
+
+    def remove_pending(self, prompt_ids):
+        self.record("remove_pending", list(prompt_ids))
+
+    def clear_pending(self):
+        self.record("clear_pending")
+
+    def remove_history(self, prompt_ids):
+        if len(prompt_ids) > 0:
+            self.record("remove_history", list(prompt_ids))
+
+    def clear_history(self):
+        self.record("clear_history")
+
+    def sync_loop(self):
+        while True:
+            with self.lock:
+                while len(self.changes) == 0 and not self.closed:
+                    self.lock.wait()
+                if self.closed:
+                    return
+            # let the changes of the interval accumulate, then write them all at once
+            time.sleep(self.sync_interval)
+            self.sync()
+
+    def sync(self):
+        with self.write_lock:
+            with self.lock:
+                changes = self.changes
+                self.changes = []
+            # pickled before the transaction, so a change that can't be doesn't roll back the others with it
+            changes = [x for x in (self.prepare(*change) for change in changes) if x is not None]
+            if len(changes) == 0:
+                return
+            try:
+                with self.connection:
+                    for change in changes:
+                        self.apply(*change)
+            except Exception as e:
+                logging.error("Failed to save {} queue changes to {}: {}".format(len(changes), self.path, e))
+
+    def prepare(self, kind, *args):
+        # the change with its record or entry pickled, None when nothing of it can be saved
+        if kind == "put":
+            item = args[0]
+            try:
+                return kind, item[1], item[0], pickle.dumps(tuple(item), protocol=pickle.HIGHEST_PROTOCOL)
+            except Exception as e:
+                logging.warning("Can't save queued prompt {} to {}: {}".format(item[1], self.path, e))
+                return None
+        if kind == "done":
+            prompt_id, entry, client_id, status, size = args
+            try:
+                data = pickle.dumps(entry, protocol=pickle.HIGHEST_PROTOCOL)
+            except Exception as e:
+                # it still leaves the pending prompts, only it won't be in the history after a restart
+                logging.warning("Can't save history entry {} to {}: {}".format(prompt_id, self.path, e))
+                data = None
+            return kind, prompt_id, entry["index"], client_id, status, size, data
+        return (kind,) + args
+
+    def apply(self, kind, *args):
+        execute = self.connection.execute
+        if kind == "put":
+            prompt_id, number, record = args
+            execute("INSERT OR REPLACE INTO pending (prompt_id, number, running, record) VALUES (?, ?, 0, ?)",
+                    (prompt_id, number, record))
+        elif kind == "start":
+            execute("UPDATE pending SET running = 1 WHERE prompt_id = ?", (args[0],))
+        elif kind == "done":
+            prompt_id, seq, client_id, status, size, entry = args
+            execute("DELETE FROM pending WHERE prompt_id = ?", (prompt_id,))
+            if entry is not None:
+                execute("INSERT OR REPLACE INTO history (prompt_id, seq, client_id, status, size, entry) "
+                        "VALUES (?, ?, ?, ?, ?, ?)", (prompt_id, seq, client_id, status, size, entry))
+        elif kind == "remove_pending":
+            self.connection.executemany("DELETE FROM pending WHERE prompt_id = ?", [(x,) for x in args[0]])
+        elif kind == "clear_pending":
+            # running prompts stay until they are done
+            execute("DELETE FROM pending WHERE running = 0")
+        elif kind == "remove_history":
+            self.connection.executemany("DELETE FROM history WHERE prompt_id = ?", [(x,) for x in args[0]])
+        elif kind == "clear_history":
+            execute("DELETE FROM history")
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+            self.lock.notify()
+        if self.thread is not None:
+            self.thread.join()
+        self.sync()
@@ -0,0 +1,221 @@
+import gc
+import logging
+import multiprocessing
+import threading
+import time
+
+import execution
+import nodes
+import server
+from comfy_execution.context import get_current_context
+
+
+class WorkerServer:
+    """
+    Stands in for the PromptServer inside a worker process. Everything the executor, the progress hook and
+    custom nodes send goes back to the main process through the worker's pipe, where it is published by the
+    real server to the client it is addressed to.
+    """
+
+    def __init__(self, connection, supports):
+        self.connection = connection
+        self.lock = threading.Lock()
+        self.supports = supports
+
+    @property
+    def client_id(self):
+        # client of the prompt executing on the calling thread
+        context = get_current_context()
+        return context.client_id if context is not None else None
+
+    @property
+    def last_node_id(self):
+        context = get_current_context()
+        return context.node_id if context is not None else None
+
+    def send_sync(self, event, data, sid=None):
+        with self.lock:
+            self.connection.send(("send", event, data, sid))
+
+    async def send(self, event, data, sid=None):
+        self.send_sync(event, data, sid)
+
+    def queue_updated(self):
+        # the queue lives in the main process, which reports its own updates
+        pass
+
+
+def _watch_interrupt(interrupt):
+    while True:
+        interrupt.wait()
+        interrupt.clear()
+        nodes.interrupt_processing()
+
+
+def worker_main(connection, interrupt, supports, create_executor, on_start, init_nodes):
+    if init_nodes is not None:
+        # processes that weren't forked start from a fresh interpreter
+        nodes.init_extra_nodes(init_custom_nodes=init_nodes)
+
+    worker_server = WorkerServer(connection, supports)
+    # custom nodes publish through PromptServer.instance
+    server.PromptServer.instance = worker_server
+    if on_start is not None:
+        on_start(worker_server)
+    executor = create_executor(worker_server)
+    threading.Thread(target=_watch_interrupt, daemon=True, args=(interrupt,)).start()
+
+    while True:
+        try:
+            message = connection.recv()
+        except (EOFError, KeyboardInterrupt):
+            return
+        if message[0] == "execute":
+            item = message[1]
+            try:
+                executor.execute(item[2], item[1], item[3], item[4])
+                done = ("done", executor.outputs_ui, executor.success, executor.status_messages)
+            except Exception as e:
+                logging.exception("Prompt {} failed".format(item[1]))
+                done = ("done", {}, False, [("execution_error", {"prompt_id": item[1], "exception_message": str(e),
+                                                                 "exception_type": type(e).__name__})])
+            connection.send(done + (executor.cache.stats(),))
+            gc.collect()
+        elif message[0] == "free":
+            executor.reset()
+            gc.collect()
+        elif message[0] == "stop":
+            return
+
+
+class Worker:
+    def __init__(self, pool, index):
+        self.pool = pool
+        self.index = index
+        self.lock = threading.Lock()
+        self.prompt_id = None
+        self.cache_stats = {}
+        self.start()
+
+    def start(self):
+        context = self.pool.context
+        self.connection, child_connection = context.Pipe()
+        self.interrupt = context.Event()
+        self.process = context.Process(target=worker_main, name="prompt_worker_{}".format(self.index), daemon=True,
+                                       args=(child_connection, self.interrupt, list(self.pool.server.supports),
+                                             self.pool.create_executor, self.pool.on_start, self.pool.init_nodes))
+        self.process.start()
+        child_connection.close()
+
+    def send(self, message):
+        with self.lock:
+            self.connection.send(message)
+
+    def run(self, item):
+        # returns the ("done", ...) message, raises EOFError when the process died before finishing the prompt
+        self.send(("execute", item))
+        while True:
+            message = self.connection.recv()
+            if message[0] == "send":
+                self.pool.server.send_sync(message[1], message[2], message[3])
+            elif message[0] == "done":
+                return message
+
+
+class WorkerPool:
+    """
+    Runs prompts in count executor processes fed from the shared PromptQueue, so a CPU-bound prompt only occupies
+    its own process. Each process has a dispatcher thread here that takes the next prompt off the queue, hands it
+    over and forwards the events it sends to the server until it reports back.
+
+    create_executor(server) builds the PromptExecutor of a worker and on_start(server) runs in each worker before
+    it, both must be picklable (module level functions) when processes can't be forked.
+
+    Module state isn't shared between workers, each has a copy of it from when it was forked, so what a node keeps
+    in a global (like nodes.global_variable of PutVariable and GetVariable) is only seen by prompts that run in
+    the same worker. Create the pool before starting any threads: a lock another thread holds while a worker is
+    forked stays held in the worker. Workers that exit are forked again by their dispatcher thread, of the locks
+    the threads of the server take a worker only uses those of logging, which are reinitialized after a fork.
+    """
+
+    def __init__(self, server, queue, count, create_executor, on_start=None, init_custom_nodes=True):
+        self.server = server
+        self.queue = queue
+        self.create_executor = create_executor
+        self.on_start = on_start
+        if "fork" in multiprocessing.get_all_start_methods():
+            self.context = multiprocessing.get_context("fork")
+            self.init_nodes = None
+        else:
+            self.context = multiprocessing.get_context("spawn")
+            self.init_nodes = init_custom_nodes
+        self.workers = [Worker(self, i) for i in range(count)]
+        server.worker_pool = self
+
+    def start(self):
+        for worker in self.workers:
+            threading.Thread(target=self.dispatch, name="prompt_dispatcher_{}".format(worker.index), daemon=True,
+                             args=(worker,)).start()
+
+    def dispatch(self, worker):
+        while True:
+            queue_item = self.queue.get(timeout=1000.0)
+            if queue_item is not None:
+                item, item_id = queue_item
+                prompt_id = item[1]
+                client_id = item[3].get("client_id", None)
+                worker.prompt_id = prompt_id
+                execution_start_time = time.perf_counter()
+                try:
+                    message = worker.run(item)
+                    _, outputs_ui, success, status_messages, worker.cache_stats = message
+                except (EOFError, OSError):
+                    logging.error("Prompt worker {} exited while running prompt {}, restarting it".format(
+                        worker.index, prompt_id))
+                    outputs_ui = {}
+                    success = False
+                    status_messages = [("execution_error", {"prompt_id": prompt_id,
+                                                            "exception_message": "Prompt worker exited",
+                                                            "exception_type": "WorkerExited"})]
+                    worker.process.join(timeout=10)
+                    worker.start()
+                worker.prompt_id = None
+
+                self.queue.task_done(item_id,
+                                     outputs_ui,
+                                     status=execution.PromptQueue.ExecutionStatus(
+                                         status_str='success' if success else 'error',
+                                         completed=success,
+                                         messages=status_messages))
+                if client_id is not None:
+                    self.server.send_sync("executing", {"node": None, "prompt_id": prompt_id}, client_id)
+                logging.info("Prompt executed in {:.2f} seconds".format(time.perf_counter() - execution_start_time))
+
+            flags = self.queue.get_flags()
+            if flags.get("free_memory", False):
+                # flags are consumed by whichever dispatcher reads them first, they concern every worker
+                for x in self.workers:
+                    try:
+                        x.send(("free",))
+                    except OSError:
+                        pass
+
+    def interrupt(self, prompt_id=None):
+        # interrupts the worker running prompt_id, or every worker when it is None
+        interrupted = False
+        for worker in self.workers:
+            if worker.prompt_id is not None and (prompt_id is None or worker.prompt_id == prompt_id):
+                worker.interrupt.set()
+                interrupted = True
+        return interrupted
+
+    def stats(self):
+        # output cache statistics summed over the workers, as last reported by each of them
+        stats = {}
+        for worker in self.workers:
+            for k, v in worker.cache_stats.items():
+                if isinstance(v, (int, float)):
+                    stats[k] = stats.get(k, 0) + v
+                else:
+                    stats[k] = v
+        return stats
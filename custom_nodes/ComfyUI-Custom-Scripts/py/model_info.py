@@ -32,19 +32,7 @@ async def save_notes(request):
 
     file_path = None
     if type == "embeddings" or type == "loras":
-        name = name.lower()
-        files = folder_paths.get_filename_list(type)
-        for f in files:
-            lower_f = f.lower()
-            if lower_f == name:
-                file_path = folder_paths.get_full_path(type, f)
-            else:
-                n = os.path.splitext(f)[0].lower()
-                if n == name:
-                    file_path = folder_paths.get_full_path(type, f)
-
-            if file_path is not None:
-                break
+        file_path = folder_paths.find_full_path(type, name)
     else:
         file_path = folder_paths.get_full_path(
             type, name)
@@ -68,19 +56,7 @@ async def load_metadata(request):
 
     file_path = None
     if type == "embeddings" or type == "loras":
-        name = name.lower()
-        files = folder_paths.get_filename_list(type)
-        for f in files:
-            lower_f = f.lower()
-            if lower_f == name:
-                file_path = folder_paths.get_full_path(type, f)
-            else:
-                n = os.path.splitext(f)[0].lower()
-                if n == name:
-                    file_path = folder_paths.get_full_path(type, f)
-
-            if file_path is not None:
-                break
+        file_path = folder_paths.find_full_path(type, name)
     else:
         file_path = folder_paths.get_full_path(
             type, name)
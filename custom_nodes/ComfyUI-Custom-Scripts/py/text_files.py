@@ -6,13 +6,21 @@ import glob
 from aiohttp import web
 
 
-def get_allowed_dirs():
+def get_allowed_dirs_file():
     dir = os.path.abspath(os.path.join(__file__, "../../user"))
-    file = os.path.join(dir, "text_file_dirs.json")
-    with open(file, "r") as f:
+    return os.path.join(dir, "text_file_dirs.json")
+
+
+def get_allowed_dirs():
+    with open(get_allowed_dirs_file(), "r") as f:
         return json.loads(f.read())
 
 
+if hasattr(PromptServer.instance, "object_info"):
+    # LoadText lists these dirs in INPUT_TYPES
+    PromptServer.instance.object_info.watch(get_allowed_dirs_file())
+
+
 def get_valid_dirs():
     return get_allowed_dirs().keys()
 
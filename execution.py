@@ -1,16 +1,24 @@
+import os
 import sys
-import copy
 import logging
 import threading
-import heapq
 import time
 import traceback
 import inspect
+import concurrent.futures
 from typing import List, Literal, NamedTuple, Optional
 
 # import torch
+import folder_paths
 import nodes
 from comfy.model_management import InterruptProcessingException
+from comfy_execution.context import ExecutionContext, set_current_context
+from comfy_execution.caching import OutputCache, SpillStore, PersistentStore, node_signature, persistent_cache_ttl, \
+    estimate_size
+from comfy_execution.history import HistoryStore
+from comfy_execution.prompt_heap import PromptHeap
+from comfy_execution.queue_store import QueueStore
+from comfy_execution.graph import PromptGraph, OutputScheduler, DependencyCycleError
 
 
 #
@@ -127,34 +135,19 @@ def format_value(x):
         return str(x)
 
 
-def recursive_execute(server, prompt, outputs, current_item, extra_data, executed, prompt_id, outputs_ui,
-                      object_storage):
+def execute_node(context, prompt, outputs, current_item, extra_data, executed, outputs_ui, object_storage):
+    # runs a single node, every linked input must already be in outputs
     unique_id = current_item
     inputs = prompt[unique_id]['inputs']
     class_type = prompt[unique_id]['class_type']
     class_def = nodes.NODE_CLASS_MAPPINGS[class_type]
-    if unique_id in outputs:
-        return (True, None, None)
-
-    for x in inputs:
-        input_data = inputs[x]
-
-        if isinstance(input_data, list):
-            input_unique_id = input_data[0]
-            output_index = input_data[1]
-            if input_unique_id not in outputs:
-                result = recursive_execute(server, prompt, outputs, input_unique_id, extra_data, executed, prompt_id,
-                                           outputs_ui, object_storage)
-                if result[0] is not True:
-                    # Another node failed further upstream
-                    return result
+    context = context.for_node(unique_id)
+    previous_context = set_current_context(context)
 
     input_data_all = None
     try:
         input_data_all = get_input_data(inputs, class_def, unique_id, outputs, prompt, extra_data)
-        if server.client_id is not None:
-            server.last_node_id = unique_id
-            server.send_sync("executing", {"node": unique_id, "prompt_id": prompt_id}, server.client_id)
+        context.send_sync("executing", {"node": unique_id, "prompt_id": context.prompt_id})
 
         obj = object_storage.get((unique_id, class_type), None)
         if obj is None:
@@ -165,9 +158,7 @@ def recursive_execute(server, prompt, outputs, current_item, extra_data, execute
         outputs[unique_id] = output_data
         if len(output_ui) > 0:
             outputs_ui[unique_id] = output_ui
-            if server.client_id is not None:
-                server.send_sync("executed", {"node": unique_id, "output": output_ui, "prompt_id": prompt_id},
-                                 server.client_id)
+            context.send_sync("executed", {"node": unique_id, "output": output_ui, "prompt_id": context.prompt_id})
     # except comfy.model_management.InterruptProcessingException as iex:
     except InterruptProcessingException as iex:
         print(iex)
@@ -189,7 +180,7 @@ def recursive_execute(server, prompt, outputs, current_item, extra_data, execute
                 input_data_formatted[name] = [format_value(x) for x in inputs]
 
         output_data_formatted = {}
-        for node_id, node_outputs in outputs.items():
+        for node_id, node_outputs in list(outputs.items()):
             output_data_formatted[node_id] = [[format_value(x) for x in l] for l in node_outputs]
 
         logging.error(f"!!! Exception during processing!!! {ex}")
@@ -204,94 +195,135 @@ def recursive_execute(server, prompt, outputs, current_item, extra_data, execute
             "current_outputs": output_data_formatted
         }
         return False, error_details, ex
+    finally:
+        set_current_context(previous_context)
 
     executed.add(unique_id)
 
     return True, None, None
 
 
-def recursive_will_execute(prompt, outputs, current_item, memo={}):
-    unique_id = current_item
-
-    if unique_id in memo:
-        return memo[unique_id]
+def execute_output(context, graph, outputs, output_node_id, extra_data, executed, outputs_ui, object_storage):
+    # runs the unexecuted nodes behind output_node_id in topological order, so every input is ready in time
+    for unique_id in graph.pending([output_node_id], outputs):
+        result = execute_node(context, graph.prompt, outputs, unique_id, extra_data, executed, outputs_ui,
+                              object_storage)
+        if result[0] is not True:
+            # Another node failed further upstream
+            return result
+    return True, None, None
 
-    inputs = prompt[unique_id]['inputs']
-    will_execute = []
-    if unique_id in outputs:
-        return []
 
-    for x in inputs:
-        input_data = inputs[x]
-        if isinstance(input_data, list):
-            input_unique_id = input_data[0]
-            output_index = input_data[1]
-            if input_unique_id not in outputs:
-                will_execute += recursive_will_execute(prompt, outputs, input_unique_id, memo)
+def is_not_parallel(prompt, unique_id):
+    class_def = nodes.NODE_CLASS_MAPPINGS[prompt[unique_id]['class_type']]
+    return getattr(class_def, "NOT_PARALLEL", False) is True
+
+
+def parallel_execute(context, graph, outputs, output_node_ids, extra_data, executed, outputs_ui, object_storage,
+                     pool):
+    """
+    Executes every node needed by output_node_ids, dispatching each node onto the pool as soon as all of its
+    linked inputs are available. Nodes whose class sets NOT_PARALLEL share state outside the graph, they run on
+    this thread one at a time while no other node runs. Returns the same (success, error_details, exception)
+    triple as execute_output, reporting the first node that failed.
+    """
+    pending = graph.pending(output_node_ids, outputs)
+    remaining = {x: 0 for x in pending}
+    for x in pending:
+        for input_unique_id in graph.upstream[x]:
+            if input_unique_id in remaining:
+                remaining[x] += 1
+
+    ready = []
+    serial = []
+    for x in pending:
+        if remaining[x] == 0:
+            (serial if is_not_parallel(graph.prompt, x) else ready).append(x)
+    running = {}
+    failure = None
+    while len(ready) > 0 or len(serial) > 0 or len(running) > 0:
+        if len(serial) > 0 and len(running) == 0 and failure is None:
+            unique_id = serial.pop(0)
+            result = execute_node(context, graph.prompt, outputs, unique_id, extra_data, executed, outputs_ui,
+                                  object_storage)
+            if result[0] is not True:
+                failure = result
+                continue
+            for x in graph.downstream[unique_id]:
+                if x in remaining:
+                    remaining[x] -= 1
+                    if remaining[x] == 0:
+                        (serial if is_not_parallel(graph.prompt, x) else ready).append(x)
+            continue
 
-    memo[unique_id] = will_execute + [unique_id]
-    return memo[unique_id]
+        # stop dispatching once a node failed, but let the running ones finish, a waiting serial node goes first
+        while len(ready) > 0 and len(serial) == 0 and failure is None:
+            unique_id = ready.pop()
+            future = pool.submit(execute_node, context, graph.prompt, outputs, unique_id, extra_data, executed,
+                                 outputs_ui, object_storage)
+            running[future] = unique_id
+        if len(running) == 0:
+            break
+
+        done, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+        for future in done:
+            unique_id = running.pop(future)
+            result = future.result()
+            if result[0] is not True:
+                if failure is None:
+                    failure = result
+                continue
+            for x in graph.downstream[unique_id]:
+                if x in remaining:
+                    remaining[x] -= 1
+                    if remaining[x] == 0:
+                        (serial if is_not_parallel(graph.prompt, x) else ready).append(x)
+
+    if failure is not None:
+        return failure
+    return True, None, None
 
 
-def recursive_output_delete_if_changed(prompt, old_prompt, outputs, current_item):
-    unique_id = current_item
+def get_node_signature(prompt, unique_id, input_signatures, outputs, hidden_unique_id):
+    # hidden_unique_id memoizes per class_type whether the node takes its UNIQUE_ID
     inputs = prompt[unique_id]['inputs']
     class_type = prompt[unique_id]['class_type']
     class_def = nodes.NODE_CLASS_MAPPINGS[class_type]
 
-    is_changed_old = ''
     is_changed = ''
-    to_delete = False
     if hasattr(class_def, 'IS_CHANGED'):
-        if unique_id in old_prompt and 'is_changed' in old_prompt[unique_id]:
-            is_changed_old = old_prompt[unique_id]['is_changed']
-        if 'is_changed' not in prompt[unique_id]:
-            input_data_all = get_input_data(inputs, class_def, unique_id, outputs)
-            if input_data_all is not None:
-                try:
-                    # is_changed = class_def.IS_CHANGED(**input_data_all)
-                    is_changed = map_node_over_list(class_def, input_data_all, "IS_CHANGED")
-                    prompt[unique_id]['is_changed'] = is_changed
-                except:
-                    to_delete = True
-        else:
-            is_changed = prompt[unique_id]['is_changed']
-
-    if unique_id not in outputs:
-        return True
-
-    if not to_delete:
-        if is_changed != is_changed_old:
-            to_delete = True
-        elif unique_id not in old_prompt:
-            to_delete = True
-        elif class_type != old_prompt[unique_id]['class_type']:
-            to_delete = True
-        elif inputs == old_prompt[unique_id]['inputs']:
-            for x in inputs:
-                input_data = inputs[x]
-
-                if isinstance(input_data, list):
-                    input_unique_id = input_data[0]
-                    output_index = input_data[1]
-                    if input_unique_id in outputs:
-                        to_delete = recursive_output_delete_if_changed(prompt, old_prompt, outputs, input_unique_id)
-                    else:
-                        to_delete = True
-                    if to_delete:
-                        break
-        else:
-            to_delete = True
+        input_data_all = get_input_data(inputs, class_def, unique_id, outputs)
+        try:
+            # is_changed = class_def.IS_CHANGED(**input_data_all)
+            is_changed = map_node_over_list(class_def, input_data_all, "IS_CHANGED")
+        except:
+            return None
 
-    if to_delete:
-        d = outputs.pop(unique_id)
-        del d
-    return to_delete
+    if class_type not in hidden_unique_id:
+        hidden = class_def.INPUT_TYPES().get("hidden", {})
+        hidden_unique_id[class_type] = "UNIQUE_ID" in hidden.values()
+    node_id = unique_id if hidden_unique_id[class_type] else None
+    return node_signature(class_type, inputs, input_signatures, is_changed, node_id)
 
 
 class PromptExecutor:
-    def __init__(self, server):
+    def __init__(self, server, threads=1, cache_size=0, cache_max_bytes=None, cache_spill_bytes=0,
+                 persistent_cache=None):
         self.server = server
+        spill = None
+        if cache_spill_bytes > 0:
+            # a directory per process, pool workers spill the same signatures under the same names
+            spill = SpillStore(os.path.join(folder_paths.get_temp_directory(), "output_cache", str(os.getpid())),
+                               cache_spill_bytes)
+        persistent = None
+        if persistent_cache is not None:
+            persistent = PersistentStore(persistent_cache)
+        self.cache = OutputCache(max_entries=cache_size, max_bytes=cache_max_bytes, spill=spill,
+                                 persistent=persistent)
+        # independent nodes run concurrently when more than one thread is allowed
+        self.pool = None
+        if threads > 1:
+            self.pool = concurrent.futures.ThreadPoolExecutor(max_workers=threads, thread_name_prefix="node_worker")
         self.reset()
 
     def reset(self):
@@ -300,7 +332,8 @@ class PromptExecutor:
         self.outputs_ui = {}
         self.status_messages = []
         self.success = True
-        self.old_prompt = {}
+        self.context = None
+        self.cache.clear()
 
     def add_message(self, event, data: dict, broadcast: bool):
         data = {
@@ -308,10 +341,9 @@ class PromptExecutor:
             "timestamp": int(time.time() * 1000),
         }
         self.status_messages.append((event, data))
-        if self.server.client_id is not None or broadcast:
-            self.server.send_sync(event, data, self.server.client_id)
+        self.context.send_sync(event, data, broadcast=broadcast)
 
-    def handle_execution_error(self, prompt_id, prompt, current_outputs, executed, error, ex):
+    def handle_execution_error(self, prompt_id, prompt, executed, error, ex):
         node_id = error["node_id"]
         class_type = prompt[node_id]["class_type"]
 
@@ -340,25 +372,11 @@ class PromptExecutor:
             }
             self.add_message("execution_error", mes, broadcast=False)
 
-        # Next, remove the subsequent outputs since they will not be executed
-        to_delete = []
-        for o in self.outputs:
-            if (o not in current_outputs) and (o not in executed):
-                to_delete += [o]
-                if o in self.old_prompt:
-                    d = self.old_prompt.pop(o)
-                    del d
-        for o in to_delete:
-            d = self.outputs.pop(o)
-            del d
-
     def execute(self, prompt, prompt_id, extra_data={}, execute_outputs=[]):
         nodes.interrupt_processing(False)
 
-        if "client_id" in extra_data:
-            self.server.client_id = extra_data["client_id"]
-        else:
-            self.server.client_id = None
+        self.context = ExecutionContext(self.server, prompt_id, extra_data.get("client_id", None))
+        previous_context = set_current_context(self.context)
 
         self.status_messages = []
         self.add_message("execution_start",
@@ -366,14 +384,6 @@ class PromptExecutor:
                          broadcast=False)
 
         # with torch.inference_mode():
-        #delete cached outputs if nodes don't exist for them
-        to_delete = []
-        for o in self.outputs:
-            if o not in prompt:
-                to_delete += [o]
-        for o in to_delete:
-            d = self.outputs.pop(o)
-            del d
         to_delete = []
         for o in self.object_storage:
             if o[0] not in prompt:
@@ -386,14 +396,26 @@ class PromptExecutor:
             d = self.object_storage.pop(o)
             del d
 
-        for x in prompt:
-            recursive_output_delete_if_changed(prompt, self.old_prompt, self.outputs, x)
+        graph = PromptGraph(prompt)
+
+        # pick up cached results by signature, inputs come first so IS_CHANGED sees the cached upstream outputs
+        self.outputs = {}
+        self.outputs_ui = {}
+        signatures = {}
+        hidden_unique_id = {}
+        for unique_id in graph.order:
+            signature = get_node_signature(prompt, unique_id, signatures, self.outputs, hidden_unique_id)
+            signatures[unique_id] = signature
+            if signature is None:
+                continue
+            class_def = nodes.NODE_CLASS_MAPPINGS[prompt[unique_id]['class_type']]
+            entry = self.cache.get(signature, persistent=persistent_cache_ttl(class_def) is not None)
+            if entry is not None:
+                self.outputs[unique_id] = entry.output
+                if entry.ui is not None:
+                    self.outputs_ui[unique_id] = entry.ui
 
         current_outputs = set(self.outputs.keys())
-        for x in list(self.outputs_ui.keys()):
-            if x not in current_outputs:
-                d = self.outputs_ui.pop(x)
-                del d
 
         # comfy.model_management.cleanup_models(keep_clone_weights_loaded=True)
         self.add_message("execution_cached",
@@ -401,31 +423,42 @@ class PromptExecutor:
                       broadcast=False)
         executed = set()
         output_node_id = None
-        to_execute = []
-
-        for node_id in list(execute_outputs):
-            to_execute += [(0, node_id)]
 
-        while len(to_execute) > 0:
-            #always execute the output that depends on the least amount of unexecuted nodes first
-            memo = {}
-            to_execute = sorted(list(map(lambda a: (len(recursive_will_execute(prompt, self.outputs, a[-1], memo)), a[-1]), to_execute)))
-            output_node_id = to_execute.pop(0)[-1]
-
-            # This call shouldn't raise anything if there's an error deep in
-            # the actual SD code, instead it will report the node where the
-            # error was raised
-            self.success, error, ex = recursive_execute(self.server, prompt, self.outputs, output_node_id, extra_data, executed, prompt_id, self.outputs_ui, self.object_storage)
+        if self.pool is not None:
+            # every output is dispatched at once, nodes start as soon as their inputs are ready
+            self.success, error, ex = parallel_execute(self.context, graph, self.outputs, execute_outputs, extra_data, executed, self.outputs_ui, self.object_storage, self.pool)
             if self.success is not True:
-                self.handle_execution_error(prompt_id, prompt, current_outputs, executed, error, ex)
-                break
+                self.handle_execution_error(prompt_id, prompt, executed, error, ex)
+            else:
+                self.add_message("execution_success", { "prompt_id": prompt_id }, broadcast=False)
         else:
-            # Only execute when the while-loop ends without break
-            self.add_message("execution_success", { "prompt_id": prompt_id }, broadcast=False)
+            #always execute the output that depends on the least amount of unexecuted nodes first
+            scheduler = OutputScheduler(graph, execute_outputs, self.outputs)
+            while len(scheduler) > 0:
+                output_node_id = scheduler.pop()
+
+                # This call shouldn't raise anything if there's an error deep in
+                # the actual SD code, instead it will report the node where the
+                # error was raised
+                self.success, error, ex = execute_output(self.context, graph, self.outputs, output_node_id, extra_data, executed, self.outputs_ui, self.object_storage)
+                if self.success is not True:
+                    self.handle_execution_error(prompt_id, prompt, executed, error, ex)
+                    break
+                scheduler.done(output_node_id)
+            else:
+                # Only execute when the while-loop ends without break
+                self.add_message("execution_success", { "prompt_id": prompt_id }, broadcast=False)
 
         for x in executed:
-            self.old_prompt[x] = copy.deepcopy(prompt[x])
-        self.server.last_node_id = None
+            if signatures[x] is not None:
+                class_def = nodes.NODE_CLASS_MAPPINGS[prompt[x]['class_type']]
+                self.cache.set(signatures[x], self.outputs[x], self.outputs_ui.get(x, None),
+                               persistent_ttl=persistent_cache_ttl(class_def))
+        self.cache.pin(x for x in signatures.values() if x is not None)
+        self.cache.evict()
+        # results only stay resident through the cache, which keeps them within its budget
+        self.outputs = {}
+        set_current_context(previous_context)
         # if comfy.model_management.DISABLE_SMART_MEMORY:
         #     comfy.model_management.unload_all_models()
 
@@ -685,10 +718,30 @@ def validate_prompt(prompt):
         }
         return (False, error, [], [])
 
+    try:
+        graph = PromptGraph(prompt)
+    except DependencyCycleError as ex:
+        error = {
+            "type": "dependency_cycle",
+            "message": "Cannot execute because the prompt contains a dependency cycle.",
+            "details": ", ".join(f"Node ID '#{x}'" for x in ex.node_ids),
+            "extra_info": {"node_ids": ex.node_ids}
+        }
+        return (False, error, [], [])
+
     good_outputs = set()
     errors = []
     node_errors = {}
     validated = {}
+    # validate inputs before the nodes using them, validate_inputs then finds every link memoized
+    # instead of recursing down long chains
+    for x in graph.pending(outputs, {}):
+        try:
+            validate_inputs(prompt, x, validated)
+        except Exception:
+            # reported below when validating the nodes depending on it
+            pass
+
     for o in outputs:
         valid = False
         reasons = []
@@ -762,36 +815,112 @@ def validate_prompt(prompt):
 MAXIMUM_HISTORY_SIZE = 10000
 
 
+class PromptRecord(NamedTuple):
+    """
+    A queued prompt. The same record is handed to the executor and shared by the pending queue, the running set,
+    the history and everything reading them, nothing is copied: once put in the queue neither the record nor the
+    prompt, extra_data and outputs it holds may be modified.
+    """
+    number: float
+    prompt_id: str
+    prompt: dict
+    extra_data: dict
+    outputs_to_execute: list
+
+
 class PromptQueue:
-    def __init__(self, server):
+    """
+    Pending prompts in a heap ordered by number, the running ones and the history of finished ones. Readers get
+    tuples of the records rather than copies, they are rebuilt after a change the first time someone asks, and
+    history entries are never modified once added. The history keeps up to MAXIMUM_HISTORY_SIZE entries, and
+    when history_max_bytes is set only as many of the latest as fit in it. Every change is also passed to store,
+    restore brings back the pending prompts and history it saved. Pending prompts are taken in the order of
+    their numbers, unless a scheduler like FairShareQueue decides.
+    """
+
+    def __init__(self, server, history_max_bytes=None, store=None, scheduler=None):
         self.server = server
         self.mutex = threading.RLock()
         self.not_empty = threading.Condition(self.mutex)
         self.task_counter = 0
-        self.queue = []
+        self.queue = scheduler if scheduler is not None else PromptHeap()
         self.currently_running = {}
-        self.history = {}
+        self.history = HistoryStore(MAXIMUM_HISTORY_SIZE, history_max_bytes)
         self.flags = {}
+        # (running, pending) as returned by get_current_queue, None after a change
+        self.snapshot = None
+        self.store = store if store is not None else QueueStore()
         server.prompt_queue = self
 
+    def restore(self, validate=None):
+        """
+        Loads what the store saved. Call it once the nodes are registered, validate(prompt) returning the result
+        of validate_prompt checks every restored prompt again, ones that are no longer valid (e.g. their node was
+        removed) are added to the history as errors instead of being queued.
+        """
+        pending, history = self.store.load()
+        with self.mutex:
+            for prompt_id, entry, client_id, status, size in history:
+                self.store.remove_history(self.history.add(prompt_id, entry, client_id, status, size))
+            for item in pending:
+                item = PromptRecord(*item)
+                error = self.revalidate(item, validate)
+                if error is None:
+                    self.queue.push(item)
+                    continue
+                logging.warning("Not restoring queued prompt {}: {}".format(item.prompt_id, error["message"]))
+                status = self.ExecutionStatus(status_str='error', completed=False, messages=[
+                    ("execution_error", {"prompt_id": item.prompt_id, "exception_message": error["message"],
+                                         "exception_type": error["type"]})])
+                entry = {"prompt": item, "outputs": {}, "status": status._asdict()}
+                client_id = item.extra_data.get("client_id", None)
+                size = estimate_size(entry)
+                evicted = self.history.add(item.prompt_id, entry, client_id, status.status_str, size)
+                self.store.done(item.prompt_id, entry, client_id, status.status_str, size)
+                self.store.remove_history(evicted)
+            self.changed()
+        if len(self.queue) > 0:
+            logging.info("Restored {} queued prompts".format(len(self.queue)))
+            # numbers of new prompts continue after the restored ones, front ones are negative
+            self.server.number = max(self.server.number, int(max(abs(x[0]) for x in pending)) + 1)
+
+    @staticmethod
+    def revalidate(item, validate):
+        # the error validate reports for item, None when it is still valid
+        if validate is None:
+            return None
+        try:
+            valid = validate(item.prompt)
+        except Exception as e:
+            return {"type": type(e).__name__, "message": str(e)}
+        return None if valid[0] else valid[1]
+
+    def changed(self):
+        # with the mutex held, after every change to the pending queue or running set
+        self.snapshot = None
+        self.server.queue_updated()
+
     def put(self, item):
-        # item - (number, prompt_id, prompt, extra_data, outputs_to_execute)
+        # item - (number, prompt_id, prompt, extra_data, outputs_to_execute), the queue takes ownership of it
+        item = PromptRecord(*item)
         with self.mutex:
-            heapq.heappush(self.queue, item)
-            self.server.queue_updated()
+            self.queue.push(item)
+            self.store.put(item)
+            self.changed()
             self.not_empty.notify()
 
     def get(self, timeout=None):
         with self.not_empty:
-            while len(self.queue) == 0:
+            while not self.queue.ready():
                 self.not_empty.wait(timeout=timeout)
-                if timeout is not None and len(self.queue) == 0:
+                if timeout is not None and not self.queue.ready():
                     return None
-            item = heapq.heappop(self.queue)
+            item = self.queue.pop()
             i = self.task_counter
-            self.currently_running[i] = copy.deepcopy(item)
+            self.currently_running[i] = item
+            self.store.start(item)
             self.task_counter += 1
-            self.server.queue_updated()
+            self.changed()
             return item, i
 
     class ExecutionStatus(NamedTuple):
@@ -801,28 +930,43 @@ class PromptQueue:
 
     def task_done(self, item_id, outputs,
                   status: Optional['PromptQueue.ExecutionStatus']):
+        # only the caller removes the item it is done with, it can be read before taking the mutex
+        prompt = self.currently_running[item_id]
+
+        status_dict: Optional[dict] = None
+        if status is not None:
+            status_dict = status._asdict()
+
+        # outputs is kept as it is, executors start every prompt with a new outputs dict
+        entry = {
+            "prompt": prompt,
+            "outputs": outputs,
+            'status': status_dict,
+        }
+        # estimated here, large prompts take a while to walk
+        size = estimate_size(entry)
         with self.mutex:
-            prompt = self.currently_running.pop(item_id)
-            if len(self.history) > MAXIMUM_HISTORY_SIZE:
-                self.history.pop(next(iter(self.history)))
-
-            status_dict: Optional[dict] = None
-            if status is not None:
-                status_dict = copy.deepcopy(status._asdict())
-
-            self.history[prompt[1]] = {
-                "prompt": prompt,
-                "outputs": copy.deepcopy(outputs),
-                'status': status_dict,
-            }
-            self.server.queue_updated()
+            self.currently_running.pop(item_id)
+            self.queue.task_done(prompt)
+            # a prompt of a tenant that was at its limit may be able to start now
+            self.not_empty.notify()
+            client_id = prompt[3].get("client_id", None)
+            status_str = None if status is None else status.status_str
+            evicted = self.history.add(prompt[1], entry, client_id, status_str, size)
+            self.store.done(prompt[1], entry, client_id, status_str, size)
+            self.store.remove_history(evicted)
+            self.changed()
 
     def get_current_queue(self):
+        # (running, pending) tuples of records, pending in heap order
         with self.mutex:
-            out = []
-            for x in self.currently_running.values():
-                out += [x]
-            return out, copy.deepcopy(self.queue)
+            if self.snapshot is None:
+                self.snapshot = (tuple(self.currently_running.values()), tuple(self.queue))
+            return self.snapshot
+
+    def get_queue_stats(self):
+        with self.mutex:
+            return self.queue.stats()
 
     def get_tasks_remaining(self):
         with self.mutex:
@@ -830,48 +974,64 @@ class PromptQueue:
 
     def wipe_queue(self):
         with self.mutex:
-            self.queue = []
-            self.server.queue_updated()
+            self.queue.clear()
+            self.store.clear_pending()
+            self.changed()
 
     def delete_queue_item(self, function):
+        # the first pending record function accepts, delete_queue_items is faster when the prompt ids are known
         with self.mutex:
-            for x in range(len(self.queue)):
-                if function(self.queue[x]):
-                    if len(self.queue) == 1:
-                        self.wipe_queue()
-                    else:
-                        self.queue.pop(x)
-                        heapq.heapify(self.queue)
-                    self.server.queue_updated()
-                    return True
+            for x in self.queue:
+                if function(x):
+                    return self.delete_queue_items([x[1]]) > 0
         return False
 
-    def get_history(self, prompt_id=None, max_items=None, offset=-1):
+    def delete_queue_items(self, prompt_ids):
+        # removes the pending prompts among prompt_ids in O(log n) each, returns how many there were
+        with self.mutex:
+            deleted = [x for x in prompt_ids if self.queue.remove(x) is not None]
+            if len(deleted) > 0:
+                self.store.remove_pending(deleted)
+                self.changed()
+            return len(deleted)
+
+    def move_to_front(self, prompt_ids):
+        """
+        Gives the pending prompts among prompt_ids numbers lower than those of every other pending prompt, keeping
+        their order relative to each other, so they run next. Returns how many were moved.
+        """
+        with self.mutex:
+            items = sorted({x[1]: x for x in map(self.queue.get, prompt_ids) if x is not None}.values())
+            if len(items) == 0:
+                return 0
+            number = min(self.queue.first()[0], 0) - len(items)
+            for i, item in enumerate(items):
+                item = item._replace(number=number + i)
+                self.queue.replace(item)
+                self.store.put(item)
+            self.changed()
+            return len(items)
+
+    def get_history(self, prompt_id=None, max_items=None, offset=-1, before=None, after=None, client_id=None,
+                    status=None):
+        # see HistoryStore.page for the paging arguments
         with self.mutex:
             if prompt_id is None:
-                out = {}
-                i = 0
-                if offset < 0 and max_items is not None:
-                    offset = len(self.history) - max_items
-                for k in self.history:
-                    if i >= offset:
-                        out[k] = self.history[k]
-                        if max_items is not None and len(out) >= max_items:
-                            break
-                    i += 1
-                return out
+                return self.history.page(max_items, offset, before, after, client_id, status)
             elif prompt_id in self.history:
-                return {prompt_id: copy.deepcopy(self.history[prompt_id])}
+                return {prompt_id: self.history.get(prompt_id)}
             else:
                 return {}
 
     def wipe_history(self):
         with self.mutex:
-            self.history = {}
+            self.history.clear()
+            self.store.clear_history()
 
     def delete_history_item(self, id_to_delete):
         with self.mutex:
-            self.history.pop(id_to_delete, None)
+            self.history.remove(id_to_delete)
+            self.store.remove_history([id_to_delete])
 
     def set_flag(self, name, data):
         with self.mutex:
@@ -1,8 +1,12 @@
 import os
 import time
+import hashlib
 import logging
+import threading
 from typing import Set, List, Dict, Tuple
 
+from comfy.folder_index import FileIndexService, FilenameIndex
+
 supported_pt_extensions: Set[str] = set(['.ckpt', '.pt', '.bin', '.pth', '.safetensors', '.pkl'])
 
 SupportedFileExtensionsType = Set[str]
@@ -43,6 +47,18 @@ input_directory = os.path.join(os.path.dirname(os.path.realpath(__file__)), "inp
 user_directory = os.path.join(os.path.dirname(os.path.realpath(__file__)), "user")
 
 filename_list_cache = {}
+# folder_name -> (filename_list_cache entry, FilenameIndex of it)
+filename_index_cache = {}
+# comfy.folder_index.FileIndexService once enable_file_index was called
+file_index = None
+# (folder, prefix) -> what follows the counter in the names of the files saved with it, e.g. "_.png"
+save_counter_suffixes = {}
+save_counter_lock = threading.Lock()
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
 if not os.path.exists(input_directory):
     try:
@@ -174,13 +190,61 @@ def filter_files_extensions(files, extensions):
 
 
 
+def enable_file_index(poll_interval=5.0):
+    """
+    Answers get_filename_list and get_full_path from an in-memory index of the folders kept up to date by
+    filesystem events, or by polling every poll_interval seconds when watchdog isn't installed.
+    """
+    global file_index
+    if file_index is None:
+        file_index = FileIndexService(poll_interval=poll_interval)
+
+def get_folder_index(folder_name):
+    folders = folder_names_and_paths[folder_name]
+    return file_index.get(folder_name, folders[0], folders[1])
+
+def get_filename_index(folder_name, refresh=True):
+    """
+    FilenameIndex of the files of folder_name, the one of the file index when enabled, otherwise the one built
+    along with filename_list_cache. With refresh=False the cached list isn't validated first, and None is
+    returned when there is none yet.
+    """
+    if file_index is not None:
+        return get_folder_index(folder_name).index
+    if refresh:
+        get_filename_list(folder_name)
+    cached = filename_index_cache.get(folder_name, None)
+    if cached is None or cached[0] is not filename_list_cache.get(folder_name, None):
+        return None
+    return cached[1]
+
+def find_full_path(folder_name, name):
+    # case insensitive, name may leave out the extension
+    if folder_name not in folder_names_and_paths:
+        return None
+    index = get_filename_index(folder_name)
+    if index is None:
+        return None
+    return index.find(name)
+
 def get_full_path(folder_name, filename):
     global folder_names_and_paths
     if folder_name not in folder_names_and_paths:
         return None
     folders = folder_names_and_paths[folder_name]
     filename = os.path.relpath(os.path.join("/", filename), "/")
-    for x in folders[0]:
+    roots = folders[0]
+    index = get_filename_index(folder_name, refresh=False)
+    if index is not None:
+        full_path = index.paths.get(filename, None)
+        # the index may be behind the disk: the file may be gone, or an earlier folder may have gained it since
+        if full_path is not None and os.path.isfile(full_path):
+            for x in roots:
+                if os.path.join(x, filename) == full_path:
+                    return full_path
+                if os.path.isfile(os.path.join(x, filename)):
+                    break
+    for x in roots:
         full_path = os.path.join(x, filename)
         if os.path.isfile(full_path):
             return full_path
@@ -189,17 +253,22 @@ def get_full_path(folder_name, filename):
 
     return None
 
-def get_filename_list_(folder_name):
+def scan_folder_(folder_name):
+    # the filename_list_cache entry of folder_name, and the absolute path each filename resolves to
     global folder_names_and_paths
-    output_list = set()
+    paths = {}
     folders = folder_names_and_paths[folder_name]
     output_folders = {}
     for x in folders[0]:
         files, folders_all = recursive_search(x, excluded_dir_names=[".git"])
-        output_list.update(filter_files_extensions(files, folders[1]))
+        for f in filter_files_extensions(files, folders[1]):
+            paths.setdefault(f, os.path.join(x, f))
         output_folders = {**output_folders, **folders_all}
 
-    return (sorted(list(output_list)), output_folders, time.perf_counter())
+    return (sorted(list(paths)), output_folders, time.perf_counter()), paths
+
+def get_filename_list_(folder_name):
+    return scan_folder_(folder_name)[0]
 
 def cached_filename_list_(folder_name):
     global filename_list_cache
@@ -223,23 +292,17 @@ def cached_filename_list_(folder_name):
     return out
 
 def get_filename_list(folder_name):
+    if file_index is not None:
+        return list(get_folder_index(folder_name).index.filenames)
     out = cached_filename_list_(folder_name)
     if out is None:
-        out = get_filename_list_(folder_name)
+        out, paths = scan_folder_(folder_name)
         global filename_list_cache
         filename_list_cache[folder_name] = out
+        filename_index_cache[folder_name] = (out, FilenameIndex(paths))
     return list(out[0])
 
 def get_save_image_path(filename_prefix, output_dir, image_width=0, image_height=0):
-    def map_filename(filename):
-        prefix_len = len(os.path.basename(filename_prefix))
-        prefix = filename[:prefix_len + 1]
-        try:
-            digits = int(filename[prefix_len + 1:].split('_')[0])
-        except:
-            digits = 0
-        return (digits, prefix)
-
     def compute_vars(input, image_width, image_height):
         input = input.replace("%width%", str(image_width))
         input = input.replace("%height%", str(image_height))
@@ -260,11 +323,69 @@ def get_save_image_path(filename_prefix, output_dir, image_width=0, image_height
         logging.error(err)
         raise Exception(err)
 
+    counter = next_save_counter(full_output_folder, filename)
+    return full_output_folder, filename, counter, subfolder, filename_prefix
+
+def scan_save_counter(full_output_folder, filename):
+    # the counter after the highest one used in the folder, and the suffixes found after the counters
+    prefix = os.path.normcase(filename) + "_"
+    counter = 0
+    suffixes = set()
     try:
-        counter = max(filter(lambda a: os.path.normcase(a[1][:-1]) == os.path.normcase(filename) and a[1][-1] == "_", map(map_filename, os.listdir(full_output_folder))))[0] + 1
-    except ValueError:
-        counter = 1
+        names = os.listdir(full_output_folder)
     except FileNotFoundError:
         os.makedirs(full_output_folder, exist_ok=True)
-        counter = 1
-    return full_output_folder, filename, counter, subfolder, filename_prefix
+        names = []
+    for name in names:
+        if os.path.normcase(name[:len(prefix)]) != prefix:
+            continue
+        rest = name[len(prefix):]
+        digits = rest.split('_')[0]
+        try:
+            counter = max(counter, int(digits))
+        except ValueError:
+            continue
+        suffixes.add(rest[len(digits):])
+    return counter + 1, suffixes
+
+def save_counter_taken(full_output_folder, filename, counter, suffixes):
+    for suffix in suffixes:
+        if os.path.exists(os.path.join(full_output_folder, f"{filename}_{counter:05}{suffix}")):
+            return True
+    return False
+
+def next_save_counter(full_output_folder, filename):
+    """
+    Hands out the counters of get_save_image_path without listing the folder every time. The next counter of each
+    (folder, prefix) is kept in a file of the temp directory, locked while it is advanced so worker processes never
+    get the same one. The folder is only listed on first use, or when the next counter turns out to be taken by a
+    file saved by someone else.
+    """
+    key = (os.path.normcase(os.path.abspath(full_output_folder)), os.path.normcase(filename))
+    counter_dir = os.path.join(get_temp_directory(), "save_counters")
+    os.makedirs(counter_dir, exist_ok=True)
+    counter_path = os.path.join(counter_dir, hashlib.sha1("\0".join(key).encode("utf-8")).hexdigest())
+
+    with save_counter_lock, open(counter_path, "a+") as f:
+        if fcntl is not None:
+            fcntl.flock(f, fcntl.LOCK_EX)
+        f.seek(0)
+        value = f.read().strip()
+        suffixes = save_counter_suffixes.get(key, None)
+        # until a file with the prefix exists there is nothing to probe for, so the folder keeps being listed
+        if not value.isdigit() or not suffixes:
+            counter, suffixes = scan_save_counter(full_output_folder, filename)
+            if value.isdigit():
+                counter = max(counter, int(value))
+        else:
+            counter = int(value)
+        if save_counter_taken(full_output_folder, filename, counter, suffixes):
+            scanned, suffixes = scan_save_counter(full_output_folder, filename)
+            counter = max(counter + 1, scanned)
+        save_counter_suffixes[key] = suffixes
+
+        f.seek(0)
+        f.truncate()
+        f.write(str(counter + 1))
+        f.flush()
+    return counter
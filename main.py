@@ -1,3 +1,6 @@
+import comfy.options
+comfy.options.enable_args_parsing()
+
 import os
 import importlib.util
 import folder_paths
@@ -86,6 +89,10 @@ import execution
 import server
 from server import BinaryEventTypes
 import nodes
+from comfy_execution.context import get_current_context
+from comfy_execution.workers import WorkerPool
+from comfy_execution.queue_store import SQLiteQueueStore
+from comfy_execution.fair_share import FairShareQueue, TENANT_KEYS
 
 
 # def cuda_malloc_warning():
@@ -99,10 +106,20 @@ import nodes
 #         if cuda_malloc_warning:
 #             logging.warning("\nWARNING: this card most likely does not support cuda-malloc, if you get \"CUDA error\" please run ComfyUI with: --disable-cuda-malloc\n")
 
+def create_executor(server):
+    persistent_cache = args.persistent_cache
+    if persistent_cache == "":
+        persistent_cache = os.path.join(folder_paths.user_directory, "output_cache.db")
+    return execution.PromptExecutor(server, threads=args.execution_threads, cache_size=args.cache_lru,
+                                    cache_max_bytes=args.cache_max_bytes, cache_spill_bytes=args.cache_spill_bytes,
+                                    persistent_cache=persistent_cache)
+
+
 def prompt_worker(q, server):
     # q - PromptQueue
     # server - PromptServer
-    e = execution.PromptExecutor(server)
+    e = create_executor(server)
+    server.output_cache = e.cache
     last_gc_collect = 0
     need_gc = False
     gc_collect_interval = 10.0
@@ -117,18 +134,26 @@ def prompt_worker(q, server):
             item, item_id = queue_item
             execution_start_time = time.perf_counter()
             prompt_id = item[1]
-            server.last_prompt_id = prompt_id
-
-            e.execute(item[2], prompt_id, item[3], item[4])
+            client_id = item[3].get("client_id", None)
+
+            try:
+                e.execute(item[2], prompt_id, item[3], item[4])
+                outputs_ui, success, status_messages = e.outputs_ui, e.success, e.status_messages
+            except Exception as ex:
+                # errors of nodes are reported by execute, this is one before any node ran, the worker carries on
+                logging.exception("Prompt {} failed".format(prompt_id))
+                outputs_ui, success = {}, False
+                status_messages = [("execution_error", {"prompt_id": prompt_id, "exception_message": str(ex),
+                                                        "exception_type": type(ex).__name__})]
             need_gc = True
             q.task_done(item_id,
-                        e.outputs_ui,
+                        outputs_ui,
                         status=execution.PromptQueue.ExecutionStatus(
-                            status_str='success' if e.success else 'error',
-                            completed=e.success,
-                            messages=e.status_messages))
-            if server.client_id is not None:
-                server.send_sync("executing", {"node": None, "prompt_id": prompt_id}, server.client_id)
+                            status_str='success' if success else 'error',
+                            completed=success,
+                            messages=status_messages))
+            if client_id is not None:
+                server.send_sync("executing", {"node": None, "prompt_id": prompt_id}, client_id)
 
             current_time = time.perf_counter()
             execution_time = current_time - execution_start_time
@@ -163,12 +188,16 @@ async def run(server, address='', port=8188, verbose=True, call_on_start=None):
 
 def hijack_progress(server):
     def hook(value, total, preview_image):
-        comfy.model_management.throw_exception_if_processing_interrupted()
-        progress = {"value": value, "max": total, "prompt_id": server.last_prompt_id, "node": server.last_node_id}
-
-        server.send_sync("progress", progress, server.client_id)
+        nodes.before_node_execution()
+        # progress belongs to the node executing on the calling thread
+        context = get_current_context()
+        if context is None:
+            return
+        progress = {"value": value, "max": total, "prompt_id": context.prompt_id, "node": context.node_id}
+
+        server.send_sync("progress", progress, context.client_id)
         if preview_image is not None:
-            server.send_sync(BinaryEventTypes.UNENCODED_PREVIEW_IMAGE, preview_image, server.client_id)
+            server.send_sync(BinaryEventTypes.UNENCODED_PREVIEW_IMAGE, preview_image, context.client_id)
 
     comfy.utils.set_progress_bar_global_hook(hook)
 
@@ -218,7 +247,18 @@ if __name__ == "__main__":
     loop = asyncio.new_event_loop()
     asyncio.set_event_loop(loop)
     server = server.PromptServer(loop)
-    q = execution.PromptQueue(server)
+    queue_store = None
+    if args.queue_db is not None:
+        queue_db = args.queue_db
+        if queue_db == "":
+            queue_db = os.path.join(folder_paths.user_directory, "queue.db")
+        queue_store = SQLiteQueueStore(queue_db, sync_interval=args.queue_db_sync_interval)
+    scheduler = None
+    if args.fair_share is not None:
+        scheduler = FairShareQueue(TENANT_KEYS[args.fair_share], dict(args.fair_share_weight),
+                                   args.tenant_max_running)
+    q = execution.PromptQueue(server, history_max_bytes=args.history_max_bytes, store=queue_store,
+                              scheduler=scheduler)
 
     # extra_model_paths_config_path = os.path.join(os.path.dirname(os.path.realpath(__file__)), "extra_model_paths.yaml")
     # if os.path.isfile(extra_model_paths_config_path):
@@ -229,14 +269,14 @@ if __name__ == "__main__":
     #         load_extra_path_config(config_path)
 
     nodes.init_extra_nodes(init_custom_nodes=not args.disable_all_custom_nodes)
+    # saved prompts are checked against the nodes that exist now
+    q.restore(validate=execution.validate_prompt)
 
     # cuda_malloc_warning()
 
     server.add_routes()
     hijack_progress(server)
 
-    threading.Thread(target=prompt_worker, daemon=True, args=(q, server,)).start()
-
     if args.output_directory:
         output_dir = os.path.abspath(args.output_directory)
         logging.info(f"Setting output directory to: {output_dir}")
@@ -252,6 +292,23 @@ if __name__ == "__main__":
         logging.info(f"Setting input directory to: {input_dir}")
         folder_paths.set_input_directory(input_dir)
 
+    if args.workers > 1:
+        # executor processes are forked from here, after the nodes and directories are set up and before any
+        # thread of ours runs, a thread holding a lock at that moment would leave it held in the child
+        pool = WorkerPool(server, q, args.workers, create_executor, on_start=hijack_progress,
+                          init_custom_nodes=not args.disable_all_custom_nodes)
+        server.output_cache = pool
+        pool.start()
+    else:
+        threading.Thread(target=prompt_worker, daemon=True, args=(q, server,)).start()
+
+    if queue_store is not None:
+        queue_store.start_sync()
+
+    if args.file_index:
+        # enabled after the worker processes are forked, they would only get a copy that isn't kept up to date
+        folder_paths.enable_file_index(poll_interval=args.file_index_poll_interval)
+
     if args.quick_test_for_ci:
         exit(0)
 
@@ -272,4 +329,6 @@ if __name__ == "__main__":
     except KeyboardInterrupt:
         logging.info("\nStopped server")
 
+    if queue_store is not None:
+        queue_store.close()
     cleanup_temp()
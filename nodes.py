@@ -115,6 +115,8 @@ class PutVariable:
     OUTPUT_NODE = True
     FUNCTION = "provide"
     CATEGORY = "base"
+    # writes global_variable, which no link in the graph shows
+    NOT_PARALLEL = True
 
     def provide(self, value, name):
         global_variable[name] = value
@@ -131,6 +133,8 @@ class GetVariable:
     RETURN_TYPES = (any,)
     FUNCTION = "provide"
     CATEGORY = "base"
+    # reads global_variable, which no link in the graph shows
+    NOT_PARALLEL = True
 
     def provide(self, name):
         if not name in global_variable.keys():
@@ -211,6 +215,21 @@ def get_module_name(module_path: str) -> str:
     return base_path
 
 
+NODES_CHANGED_CALLBACKS = []
+
+
+def add_nodes_changed_callback(callback):
+    """
+    callback() is called whenever nodes are registered, for anything derived from NODE_CLASS_MAPPINGS.
+    """
+    NODES_CHANGED_CALLBACKS.append(callback)
+
+
+def nodes_changed():
+    for callback in NODES_CHANGED_CALLBACKS:
+        callback()
+
+
 def load_custom_node(module_path: str, ignore=set(), module_parent="custom_nodes") -> bool:
     module_name = os.path.basename(module_path)
     if os.path.isfile(module_path):
@@ -242,6 +261,7 @@ def load_custom_node(module_path: str, ignore=set(), module_parent="custom_nodes
             if hasattr(module, "NODE_DISPLAY_NAME_MAPPINGS") and getattr(module,
                                                                          "NODE_DISPLAY_NAME_MAPPINGS") is not None:
                 NODE_DISPLAY_NAME_MAPPINGS.update(module.NODE_DISPLAY_NAME_MAPPINGS)
+            nodes_changed()
             return True
         else:
             logging.warning(f"Skip {module_path} module for custom nodes due to the lack of NODE_CLASS_MAPPINGS.")
@@ -1,12 +1,12 @@
 import asyncio
 import glob
-import json
 import logging
 import mimetypes
 import os
 import ssl
 import struct
 import sys
+import threading
 import traceback
 import urllib
 import uuid
@@ -23,9 +23,16 @@ import folder_paths
 # import comfy.model_management
 import node_helpers
 import nodes
+from app.client_connection import ClientConnection
 from app.frontend_management import FrontendManager
+from app.hash_index import HashIndex
+from app.image_executor import ImageExecutor
+from app.object_info import ObjectInfoCache, node_info
+from app.uploads import UploadedFile, discard_uploads, read_multipart
 from app.user_manager import UserManager
+from comfy import json_util
 from comfy.cli_args import args
+from comfy_execution.context import get_current_context
 
 
 class BinaryEventTypes:
@@ -33,11 +40,14 @@ class BinaryEventTypes:
     UNENCODED_PREVIEW_IMAGE = 2
 
 
-async def send_socket_catch_exception(function, message):
-    try:
-        await function(message)
-    except (aiohttp.ClientError, aiohttp.ClientPayloadError, ConnectionResetError) as err:
-        logging.warning("send error: {}".format(err))
+def json_response(data, status=200, headers=None):
+    # web.json_response, encoded with comfy.json_util
+    return web.Response(body=json_util.dumps_bytes(data), status=status, headers=headers,
+                        content_type="application/json")
+
+
+# events a later event of the same kind supersedes, they are the first dropped from the buffer of a slow client
+DROPPABLE_EVENTS = ("status", "progress", BinaryEventTypes.PREVIEW_IMAGE)
 
 
 @web.middleware
@@ -66,6 +76,80 @@ def create_cors_middleware(allowed_origin: str):
     return cors_middleware
 
 
+def coalesce_messages(messages):
+    """
+    Drops the status, progress and preview messages that a later message to the same client supersedes:
+    only the latest status, the latest progress of each node and the latest preview image are kept.
+    """
+    seen = set()
+    result = []
+    for event, data, sid in reversed(messages):
+        key = None
+        if event == "status":
+            key = (event, sid)
+        elif event == "progress":
+            key = (event, sid, data.get("prompt_id", None), data.get("node", None))
+        elif event == BinaryEventTypes.UNENCODED_PREVIEW_IMAGE:
+            key = (event, sid)
+        if key is not None:
+            if key in seen:
+                continue
+            seen.add(key)
+        result.append((event, data, sid))
+    result.reverse()
+    return result
+
+
+def render_view_image(file, preview=None, channel=None):
+    """
+    The image /view answers with for the preview and channel query parameters, as (body, content_type). None when
+    the file is sent as it is.
+    """
+    if preview is not None:
+        with Image.open(file) as img:
+            preview_info = preview.split(';')
+            image_format = preview_info[0]
+            if image_format not in ['webp', 'jpeg'] or 'a' in (channel or ''):
+                image_format = 'webp'
+
+            quality = 90
+            if preview_info[-1].isdigit():
+                quality = int(preview_info[-1])
+
+            buffer = BytesIO()
+            if image_format in ['jpeg'] or channel == 'rgb':
+                img = img.convert("RGB")
+            img.save(buffer, format=image_format, quality=quality)
+            return buffer.getvalue(), f'image/{image_format}'
+
+    if channel == 'rgb':
+        with Image.open(file) as img:
+            if img.mode == "RGBA":
+                r, g, b, a = img.split()
+                new_img = Image.merge('RGB', (r, g, b))
+            else:
+                new_img = img.convert("RGB")
+
+            buffer = BytesIO()
+            new_img.save(buffer, format='PNG')
+            return buffer.getvalue(), 'image/png'
+
+    elif channel == 'a':
+        with Image.open(file) as img:
+            if img.mode == "RGBA":
+                _, _, _, a = img.split()
+            else:
+                a = Image.new('L', img.size, 255)
+
+            # alpha img
+            alpha_img = Image.new('RGBA', img.size)
+            alpha_img.putalpha(a)
+            alpha_buffer = BytesIO()
+            alpha_img.save(alpha_buffer, format='PNG')
+            return alpha_buffer.getvalue(), 'image/png'
+    return None
+
+
 class PromptServer:
     def __init__(self, loop):
         PromptServer.instance = self
@@ -79,13 +163,25 @@ class PromptServer:
         self.loop = loop
         self.messages = asyncio.Queue()
         self.number = 0
+        # batched publishing, send_sync only wakes the loop up for the first message of a batch
+        self.batch_interval = args.ws_batch_interval / 1000.0
+        self.batch_lock = threading.Lock()
+        self.batch_pending = []
+        self.batch_ready = asyncio.Event()
+        if self.batch_interval > 0:
+            self.supports.append("ws_batch")
 
         middlewares = [cache_control]
         if args.enable_cors_header:
             middlewares.append(create_cors_middleware(args.enable_cors_header))
 
         max_upload_size = round(args.max_upload_size * 1024 * 1024)
+        # also enforced on uploads, which are streamed past client_max_size
+        self.max_upload_size = max_upload_size
+        self.hash_index = HashIndex(os.path.join(folder_paths.user_directory, "upload_hashes.db"))
+        self.image_executor = ImageExecutor(args.image_workers, args.image_queue_size)
         self.app = web.Application(client_max_size=max_upload_size, middlewares=middlewares)
+        # sid -> ClientConnection
         self.sockets = dict()
         self.web_root = (
             FrontendManager.init_frontend(args.front_end_version)
@@ -95,10 +191,13 @@ class PromptServer:
         logging.info(f"[Prompt Server] web root: {self.web_root}")
         routes = web.RouteTableDef()
         self.routes = routes
-        self.last_node_id = None
-        self.client_id = None
+        self.output_cache = None
+        self.worker_pool = None
+        # last "executing" event sent to each client, replayed when it reconnects
+        self.client_executing = {}
 
         self.on_prompt_handlers = []
+        self.object_info = ObjectInfoCache()
 
         @routes.get('/ws')
         async def websocket_handler(request):
@@ -107,24 +206,32 @@ class PromptServer:
             sid = request.rel_url.query.get('clientId', '')
             if sid:
                 # Reusing existing session, remove old
-                self.sockets.pop(sid, None)
+                old = self.sockets.pop(sid, None)
+                if old is not None:
+                    old.close()
             else:
                 sid = uuid.uuid4().hex
 
-            self.sockets[sid] = ws
+            connection = ClientConnection(ws, batch=request.rel_url.query.get('batch', '') == '1',
+                                          max_buffer=args.ws_buffer_size, overflow=args.ws_overflow)
+            connection.start()
+            self.sockets[sid] = connection
 
             try:
                 # Send initial state to the new client
-                await self.send("status", {"status": self.get_queue_info(), 'sid': sid}, sid)
+                await self.send("status", {"status": self.get_queue_info(), 'sid': sid, 'supports': self.supports},
+                                sid)
                 # On reconnect if we are the currently executing client send the current node
-                if self.client_id == sid and self.last_node_id is not None:
-                    await self.send("executing", {"node": self.last_node_id}, sid)
+                if sid in self.client_executing:
+                    await self.send("executing", self.client_executing[sid], sid)
 
                 async for msg in ws:
                     if msg.type == aiohttp.WSMsgType.ERROR:
                         logging.warning('ws connection closed with exception %s' % ws.exception())
             finally:
-                self.sockets.pop(sid, None)
+                connection.close()
+                if self.sockets.get(sid, None) is connection:
+                    self.sockets.pop(sid, None)
             return ws
 
         @routes.get("/")
@@ -134,7 +241,7 @@ class PromptServer:
         @routes.get("/embeddings")
         def get_embeddings(self):
             embeddings = folder_paths.get_filename_list("embeddings")
-            return web.json_response(list(map(lambda a: os.path.splitext(a)[0], embeddings)))
+            return json_response(list(map(lambda a: os.path.splitext(a)[0], embeddings)))
 
         @routes.get("/extensions")
         async def get_extensions(request):
@@ -148,7 +255,7 @@ class PromptServer:
                 extensions.extend(list(map(lambda f: "/extensions/" + urllib.parse.quote(
                     name) + "/" + os.path.relpath(f, dir).replace("\\", "/"), files)))
 
-            return web.json_response(extensions)
+            return json_response(extensions)
 
         def get_dir_by_type(dir_type):
             if dir_type is None:
@@ -167,17 +274,34 @@ class PromptServer:
             hasher = node_helpers.hasher()
 
             # function to compare hashes of two images to see if it already exists, fix to #3465
-            if os.path.exists(filepath):
-                a = hasher()
-                b = hasher()
-                with open(filepath, "rb") as f:
-                    a.update(f.read())
-                    b.update(image.file.read())
-                    image.file.seek(0)
-                    f.close()
-                return a.hexdigest() == b.hexdigest()
+            # the upload was hashed while it was received, the existing file only when the index has no digest for it
+            if os.path.exists(filepath) and os.path.getsize(filepath) == image.size:
+                return self.hash_index.digest(filepath, hasher) == image.digest
             return False
 
+        def upload_name(full_output_folder, filename, upload):
+            # (filename, filepath, is_duplicate), a new "name (i).ext" when filename is taken by different content
+            filepath = os.path.join(full_output_folder, filename)
+            duplicate = self.hash_index.find_duplicate(full_output_folder, filename, upload.size, upload.digest,
+                                                       node_helpers.hasher())
+            if duplicate is not None:
+                return duplicate, os.path.join(full_output_folder, duplicate), True
+
+            split = os.path.splitext(filename)
+            i = 1
+            while os.path.exists(filepath):
+                if compare_image_hash(filepath,
+                                      upload):  #compare hash to prevent saving of duplicates with same name, fix for #3465
+                    return filename, filepath, True
+                filename = f"{split[0]} ({i}){split[1]}"
+                filepath = os.path.join(full_output_folder, filename)
+                i += 1
+            return filename, filepath, False
+
+        def store_upload(upload, filepath):
+            upload.store(filepath)
+            self.hash_index.record(filepath, upload.digest, node_helpers.hasher()().name)
+
         def image_upload(post, image_save_function=None):
             image = post.get("image")
             overwrite = post.get("overwrite")
@@ -186,7 +310,7 @@ class PromptServer:
             image_upload_type = post.get("type")
             upload_dir, image_upload_type = get_dir_by_type(image_upload_type)
 
-            if image and image.file:
+            if isinstance(image, UploadedFile):
                 filename = image.filename
                 if not filename:
                     return web.Response(status=400)
@@ -201,29 +325,18 @@ class PromptServer:
                 if not os.path.exists(full_output_folder):
                     os.makedirs(full_output_folder)
 
-                split = os.path.splitext(filename)
-
                 if overwrite is not None and (overwrite == "true" or overwrite == "1"):
                     pass
                 else:
-                    i = 1
-                    while os.path.exists(filepath):
-                        if compare_image_hash(filepath,
-                                              image):  #compare hash to prevent saving of duplicates with same name, fix for #3465
-                            image_is_duplicate = True
-                            break
-                        filename = f"{split[0]} ({i}){split[1]}"
-                        filepath = os.path.join(full_output_folder, filename)
-                        i += 1
+                    filename, filepath, image_is_duplicate = upload_name(full_output_folder, filename, image)
 
                 if not image_is_duplicate:
                     if image_save_function is not None:
                         image_save_function(image, post, filepath)
                     else:
-                        with open(filepath, "wb") as f:
-                            f.write(image.file.read())
+                        store_upload(image, filepath)
 
-                return web.json_response({"name": filename, "subfolder": subfolder, "type": image_upload_type})
+                return json_response({"name": filename, "subfolder": subfolder, "type": image_upload_type})
             else:
                 return web.Response(status=400)
 
@@ -235,7 +348,7 @@ class PromptServer:
             upload_type = post.get("type")
             upload_dir, upload_type = get_dir_by_type(upload_type)
 
-            if file_d and file_d.file:
+            if isinstance(file_d, UploadedFile):
                 filename = file_d.filename
                 if not filename:
                     return web.Response(status=400)
@@ -250,48 +363,51 @@ class PromptServer:
                 if not os.path.exists(full_output_folder):
                     os.makedirs(full_output_folder)
 
-                split = os.path.splitext(filename)
-
                 if overwrite is not None and (overwrite == "true" or overwrite == "1"):
                     pass
                 else:
-                    i = 1
-                    while os.path.exists(filepath):
-                        if compare_image_hash(filepath,
-                                              file_d):  #compare hash to prevent saving of duplicates with same name, fix for #3465
-                            image_is_duplicate = True
-                            break
-                        filename = f"{split[0]} ({i}){split[1]}"
-                        filepath = os.path.join(full_output_folder, filename)
-                        i += 1
+                    filename, filepath, is_duplicate = upload_name(full_output_folder, filename, file_d)
 
                 if not is_duplicate:
                     if save_function is not None:
                         save_function(file_d, post, filepath)
                     else:
-                        with open(filepath, "wb") as f:
-                            f.write(file_d.file.read())
+                        store_upload(file_d, filepath)
 
-                return web.json_response({"name": filename, "subfolder": subfolder, "type": upload_type})
+                return json_response({"name": filename, "subfolder": subfolder, "type": upload_type})
             else:
                 return web.Response(status=400)
 
+        async def read_upload(request):
+            stage_dir = os.path.join(folder_paths.get_temp_directory(), ".uploads")
+            return await read_multipart(request, stage_dir, node_helpers.hasher(), self.max_upload_size)
+
+        async def handle_upload(post, upload_function, *args, image=False):
+            # storing and deduplicating touch the disk, so they run on the executor's threads, on the image threads
+            # when the upload is processed with PIL
+            try:
+                if image:
+                    return await self.image_executor.run(upload_function, post, *args)
+                return await self.loop.run_in_executor(None, upload_function, post, *args)
+            finally:
+                discard_uploads(post)
+
         @routes.post("/upload/image")
         async def upload_image(request):
-            post = await request.post()
-            return image_upload(post)
+            post = await read_upload(request)
+            return await handle_upload(post, image_upload)
 
         @routes.post("/upload/file")
         async def upload_file(request):
-            post = await request.post()
-            return file_upload(post)
+            post = await read_upload(request)
+            return await handle_upload(post, file_upload)
 
         @routes.post("/upload/mask")
         async def upload_mask(request):
-            post = await request.post()
+            post = await read_upload(request)
 
             def image_save_function(image, post, filepath):
-                original_ref = json.loads(post.get("original_ref"))
+                original_ref = json_util.loads(post.get("original_ref"))
                 filename, output_dir = folder_paths.annotated_filepath(original_ref['filename'])
 
                 # validation for security: prevent accessing arbitrary path
@@ -327,7 +443,7 @@ class PromptServer:
                         original_pil.putalpha(new_alpha)
                         original_pil.save(filepath, compress_level=4, pnginfo=metadata)
 
-            return image_upload(post, image_save_function)
+            return await handle_upload(post, image_upload, image_save_function, image=True)
 
         @routes.get("/view")
         async def view_image(request):
@@ -356,64 +472,15 @@ class PromptServer:
                 file = os.path.join(output_dir, filename)
 
                 if os.path.isfile(file):
-                    if 'preview' in request.rel_url.query:
-                        with Image.open(file) as img:
-                            preview_info = request.rel_url.query['preview'].split(';')
-                            image_format = preview_info[0]
-                            if image_format not in ['webp', 'jpeg'] or 'a' in request.rel_url.query.get('channel', ''):
-                                image_format = 'webp'
-
-                            quality = 90
-                            if preview_info[-1].isdigit():
-                                quality = int(preview_info[-1])
-
-                            buffer = BytesIO()
-                            if image_format in ['jpeg'] or request.rel_url.query.get('channel', '') == 'rgb':
-                                img = img.convert("RGB")
-                            img.save(buffer, format=image_format, quality=quality)
-                            buffer.seek(0)
-
-                            return web.Response(body=buffer.read(), content_type=f'image/{image_format}',
-                                                headers={"Content-Disposition": f"filename=\"{filename}\""})
-
-                    if 'channel' not in request.rel_url.query:
-                        channel = 'rgba'
-                    else:
-                        channel = request.rel_url.query["channel"]
-
-                    if channel == 'rgb':
-                        with Image.open(file) as img:
-                            if img.mode == "RGBA":
-                                r, g, b, a = img.split()
-                                new_img = Image.merge('RGB', (r, g, b))
-                            else:
-                                new_img = img.convert("RGB")
-
-                            buffer = BytesIO()
-                            new_img.save(buffer, format='PNG')
-                            buffer.seek(0)
-
-                            return web.Response(body=buffer.read(), content_type='image/png',
-                                                headers={"Content-Disposition": f"filename=\"{filename}\""})
-
-                    elif channel == 'a':
-                        with Image.open(file) as img:
-                            if img.mode == "RGBA":
-                                _, _, _, a = img.split()
-                            else:
-                                a = Image.new('L', img.size, 255)
-
-                            # alpha img
-                            alpha_img = Image.new('RGBA', img.size)
-                            alpha_img.putalpha(a)
-                            alpha_buffer = BytesIO()
-                            alpha_img.save(alpha_buffer, format='PNG')
-                            alpha_buffer.seek(0)
-
-                            return web.Response(body=alpha_buffer.read(), content_type='image/png',
-                                                headers={"Content-Disposition": f"filename=\"{filename}\""})
-                    else:
+                    # decoding and encoding happen on the image threads, the event loop only waits for them
+                    image = await self.image_executor.run(render_view_image, file,
+                                                          request.rel_url.query.get('preview', None),
+                                                          request.rel_url.query.get('channel', None))
+                    if image is None:
                         return web.FileResponse(file, headers={"Content-Disposition": f"filename=\"{filename}\""})
+                    body, content_type = image
+                    return web.Response(body=body, content_type=content_type,
+                                        headers={"Content-Disposition": f"filename=\"{filename}\""})
 
             return web.Response(status=404)
 
@@ -464,52 +531,39 @@ class PromptServer:
                 #     }
                 # ]
             }
-            return web.json_response(system_stats)
+            system_stats["websockets"] = {sid: x.stats() for sid, x in self.sockets.items()}
+            system_stats["image_executor"] = self.image_executor.stats()
+            if self.prompt_queue is not None:
+                system_stats["history"] = self.prompt_queue.history.stats()
+                # pending prompts, and per client or user with --fair-share
+                system_stats["queue"] = self.prompt_queue.get_queue_stats()
+            return json_response(system_stats)
+
+        @routes.get("/cache")
+        async def get_cache(request):
+            if self.output_cache is None:
+                return json_response({})
+            return json_response(self.output_cache.stats())
 
         @routes.get("/prompt")
         async def get_prompt(request):
-            return web.json_response(self.get_queue_info())
-
-        def node_info(node_class):
-            """
-            获取节点信息
-            :param node_class:
-            :return:
-            """
-            obj_class = nodes.NODE_CLASS_MAPPINGS[node_class]
-            info = {}
-            info['input'] = obj_class.INPUT_TYPES()
-            info['output'] = obj_class.RETURN_TYPES
-            info['output_is_list'] = obj_class.OUTPUT_IS_LIST if hasattr(obj_class, 'OUTPUT_IS_LIST') else [
-                                                                                                               False] * len(
-                obj_class.RETURN_TYPES)
-            info['output_name'] = obj_class.RETURN_NAMES if hasattr(obj_class, 'RETURN_NAMES') else info['output']
-            info['name'] = node_class
-            info['display_name'] = nodes.NODE_DISPLAY_NAME_MAPPINGS[
-                node_class] if node_class in nodes.NODE_DISPLAY_NAME_MAPPINGS.keys() else node_class
-            info['description'] = obj_class.DESCRIPTION if hasattr(obj_class, 'DESCRIPTION') else ''
-            info['python_module'] = getattr(obj_class, "RELATIVE_PYTHON_MODULE", "nodes")
-            info['category'] = 'sd'
-            if hasattr(obj_class, 'OUTPUT_NODE') and obj_class.OUTPUT_NODE == True:
-                info['output_node'] = True
-            else:
-                info['output_node'] = False
-
-            if hasattr(obj_class, 'CATEGORY'):
-                info['category'] = obj_class.CATEGORY
-            return info
+            return json_response(self.get_queue_info())
 
         # 拉取所有节点信息
         @routes.get("/object_info")
         async def get_object_info(request):
-            out = {}
-            for x in nodes.NODE_CLASS_MAPPINGS:
-                try:
-                    out[x] = node_info(x)
-                except Exception as e:
-                    logging.error(f"[ERROR] An error occurred while retrieving information for the '{x}' node.")
-                    logging.error(traceback.format_exc())
-            return web.json_response(out)
+            _, body, etag = await self.loop.run_in_executor(None, self.object_info.get)
+            # the version token clients pass to /object_info/diff later on
+            headers = {"ETag": etag, "Cache-Control": "no-cache", "Object-Info-Version": self.object_info.token()}
+            if request.headers.get("If-None-Match", None) == etag:
+                return web.Response(status=304, headers=headers)
+            return web.Response(body=body, headers=headers, content_type="application/json")
+
+        # 拉取自某个版本以来变化的节点信息
+        @routes.get("/object_info/diff")
+        async def get_object_info_diff(request):
+            since = request.rel_url.query.get("since", None)
+            return json_response(await self.loop.run_in_executor(None, self.object_info.diff, since))
 
         # 拉取指定节点信息
         @routes.get("/object_info/{node_class}")
@@ -518,19 +572,26 @@ class PromptServer:
             out = {}
             if (node_class is not None) and (node_class in nodes.NODE_CLASS_MAPPINGS):
                 out[node_class] = node_info(node_class)
-            return web.json_response(out)
+            return json_response(out)
 
         @routes.get("/history")
         async def get_history(request):
-            max_items = request.rel_url.query.get("max_items", None)
-            if max_items is not None:
-                max_items = int(max_items)
-            return web.json_response(self.prompt_queue.get_history(max_items=max_items))
+            # before and after page by the "index" of the entries, client_id and status ("success" or "error") filter
+            query = request.rel_url.query
+            paging = {}
+            try:
+                for name in ("max_items", "offset", "before", "after"):
+                    if name in query:
+                        paging[name] = int(query[name])
+            except ValueError:
+                return json_response({"error": "{} must be an integer".format(name)}, status=400)
+            return json_response(self.prompt_queue.get_history(client_id=query.get("client_id", None),
+                                                               status=query.get("status", None), **paging))
 
         @routes.get("/history/{prompt_id}")
         async def get_history(request):
             prompt_id = request.match_info.get("prompt_id", None)
-            return web.json_response(self.prompt_queue.get_history(prompt_id=prompt_id))
+            return json_response(self.prompt_queue.get_history(prompt_id=prompt_id))
 
         @routes.get("/queue")
         async def get_queue(request):
@@ -538,14 +599,14 @@ class PromptServer:
             current_queue = self.prompt_queue.get_current_queue()
             queue_info['queue_running'] = current_queue[0]
             queue_info['queue_pending'] = current_queue[1]
-            return web.json_response(queue_info)
+            return json_response(queue_info)
 
         @routes.post("/prompt")
         async def post_prompt(request):
             logging.info("got prompt")
             resp_code = 200
             out_string = ""
-            json_data = await request.json()
+            json_data = await request.json(loads=json_util.loads)
             json_data = self.trigger_on_prompt(json_data)
 
             if "number" in json_data:
@@ -567,41 +628,57 @@ class PromptServer:
 
                 if "client_id" in json_data:
                     extra_data["client_id"] = json_data["client_id"]
+                if args.fair_share == "user":
+                    try:
+                        extra_data["user_id"] = self.user_manager.get_request_user_id(request)
+                    except KeyError as e:
+                        return json_response({"error": str(e), "node_errors": []}, status=400)
                 if valid[0]:
                     prompt_id = str(uuid.uuid4())
                     outputs_to_execute = valid[2]
                     self.prompt_queue.put((number, prompt_id, prompt, extra_data, outputs_to_execute))
                     response = {"prompt_id": prompt_id, "number": number, "node_errors": valid[3]}
-                    return web.json_response(response)
+                    return json_response(response)
                 else:
                     logging.warning("invalid prompt: {}".format(valid[1]))
-                    return web.json_response({"error": valid[1], "node_errors": valid[3]}, status=400)
+                    return json_response({"error": valid[1], "node_errors": valid[3]}, status=400)
             else:
-                return web.json_response({"error": "no prompt", "node_errors": []}, status=400)
+                return json_response({"error": "no prompt", "node_errors": []}, status=400)
 
         @routes.post("/queue")
         async def post_queue(request):
-            json_data = await request.json()
+            json_data = await request.json(loads=json_util.loads)
             if "clear" in json_data:
                 if json_data["clear"]:
                     self.prompt_queue.wipe_queue()
             if "delete" in json_data:
                 to_delete = json_data['delete']
-                for id_to_delete in to_delete:
-                    delete_func = lambda a: a[1] == id_to_delete
-                    self.prompt_queue.delete_queue_item(delete_func)
+                self.prompt_queue.delete_queue_items(to_delete)
+            if "front" in json_data:
+                # move pending prompts to the front of the queue, in their current order
+                self.prompt_queue.move_to_front(json_data["front"])
 
             return web.Response(status=200)
 
         @routes.post("/interrupt")
         async def post_interrupt(request):
-            nodes.interrupt_processing()
+            prompt_id = None
+            if request.can_read_body:
+                json_data = await request.json(loads=json_util.loads)
+                prompt_id = json_data.get("prompt_id", None)
+
+            if self.worker_pool is not None:
+                self.worker_pool.interrupt(prompt_id)
+            else:
+                running, _ = self.prompt_queue.get_current_queue()
+                if prompt_id is None or any(x[1] == prompt_id for x in running):
+                    nodes.interrupt_processing()
             logging.info('-' * 30, 'interrupt')
             return web.Response(status=200)
 
         @routes.post("/free")
         async def post_free(request):
-            json_data = await request.json()
+            json_data = await request.json(loads=json_util.loads)
             unload_models = json_data.get("unload_models", False)
             free_memory = json_data.get("free_memory", False)
             if unload_models:
@@ -612,7 +689,7 @@ class PromptServer:
 
         @routes.post("/history")
         async def post_history(request):
-            json_data = await request.json()
+            json_data = await request.json(loads=json_util.loads)
             if "clear" in json_data:
                 if json_data["clear"]:
                     self.prompt_queue.wipe_history()
@@ -657,7 +734,26 @@ class PromptServer:
         prompt_info['exec_info'] = exec_info
         return prompt_info
 
+    @property
+    def client_id(self):
+        # client of the prompt executing on the calling thread, for custom nodes that send their own events
+        context = get_current_context()
+        return context.client_id if context is not None else None
+
+    @property
+    def last_node_id(self):
+        context = get_current_context()
+        return context.node_id if context is not None else None
+
+    def track_executing(self, data, sid):
+        if data.get("node", None) is None:
+            self.client_executing.pop(sid, None)
+        else:
+            self.client_executing[sid] = data
+
     async def send(self, event, data, sid=None):
+        if event == "executing" and sid is not None:
+            self.track_executing(data, sid)
         if event == BinaryEventTypes.UNENCODED_PREVIEW_IMAGE:
             await self.send_image(data, sid=sid)
         elif isinstance(data, (bytes, bytearray)):
@@ -675,6 +771,9 @@ class PromptServer:
         return message
 
     async def send_image(self, image_data, sid=None):
+        await self.send_bytes(BinaryEventTypes.PREVIEW_IMAGE, self.encode_image(image_data), sid=sid)
+
+    def encode_image(self, image_data):
         image_type = image_data[0]
         image = image_data[1]
         max_size = image_data[2]
@@ -695,30 +794,42 @@ class PromptServer:
         header = struct.pack(">I", type_num)
         bytesIO.write(header)
         image.save(bytesIO, format=image_type, quality=95, compress_level=1)
-        preview_bytes = bytesIO.getvalue()
-        await self.send_bytes(BinaryEventTypes.PREVIEW_IMAGE, preview_bytes, sid=sid)
+        return bytesIO.getvalue()
+
+    def encode_frame(self, event, data):
+        # (frame, droppable) of a message the way send would enqueue it, for sending it to several sockets
+        if event == BinaryEventTypes.UNENCODED_PREVIEW_IMAGE:
+            event = BinaryEventTypes.PREVIEW_IMAGE
+            data = self.encode_image(data)
+        if isinstance(data, (bytes, bytearray)):
+            return bytes(self.encode_bytes(event, data)), event in DROPPABLE_EVENTS
+        return json_util.dumps({"type": event, "data": data}), event in DROPPABLE_EVENTS
 
     async def send_bytes(self, event, data, sid=None):
         message = self.encode_bytes(event, data)
-
-        if sid is None:
-            sockets = list(self.sockets.values())
-            for ws in sockets:
-                await send_socket_catch_exception(ws.send_bytes, message)
-        elif sid in self.sockets:
-            await send_socket_catch_exception(self.sockets[sid].send_bytes, message)
+        self.enqueue(bytes(message), event in DROPPABLE_EVENTS, sid)
 
     async def send_json(self, event, data, sid=None):
-        message = {"type": event, "data": data}
+        message = json_util.dumps({"type": event, "data": data})
+        self.enqueue(message, event in DROPPABLE_EVENTS, sid)
 
+    def enqueue(self, frame, droppable, sid=None):
+        # every connection sends from its own buffer, broadcasting doesn't wait for any of them
         if sid is None:
-            sockets = list(self.sockets.values())
-            for ws in sockets:
-                await send_socket_catch_exception(ws.send_json, message)
+            for connection in list(self.sockets.values()):
+                connection.enqueue(frame, droppable)
         elif sid in self.sockets:
-            await send_socket_catch_exception(self.sockets[sid].send_json, message)
+            self.sockets[sid].enqueue(frame, droppable)
 
     def send_sync(self, event, data, sid=None):
+        if self.batch_interval > 0:
+            with self.batch_lock:
+                self.batch_pending.append((event, data, sid))
+                if len(self.batch_pending) > 1:
+                    # the loop was already woken up for this batch
+                    return
+            self.loop.call_soon_threadsafe(self.batch_ready.set)
+            return
         self.loop.call_soon_threadsafe(
             self.messages.put_nowait, (event, data, sid))
 
@@ -726,10 +837,69 @@ class PromptServer:
         self.send_sync("status", {"status": self.get_queue_info()})
 
     async def publish_loop(self):
+        if self.batch_interval > 0:
+            await self.publish_batch_loop()
+            return
         while True:
             msg = await self.messages.get()
             await self.send(*msg)
 
+    async def publish_batch_loop(self):
+        # messages put directly on self.messages are still published, as part of the next batch
+        asyncio.ensure_future(self.forward_messages())
+        while True:
+            await self.batch_ready.wait()
+            await asyncio.sleep(self.batch_interval)
+            with self.batch_lock:
+                self.batch_ready.clear()
+                messages = self.batch_pending
+                self.batch_pending = []
+            await self.send_batch(coalesce_messages(messages))
+
+    async def forward_messages(self):
+        while True:
+            msg = await self.messages.get()
+            self.send_sync(*msg)
+
+    async def send_batch(self, messages):
+        """
+        Sends messages in order. Sockets that connected with batch=1 get all of their consecutive json messages in
+        one {"type": "batch", "data": [...]} frame, binary messages are sent on their own in between. Each message
+        is encoded at most once however many sockets it goes to, previews included.
+        """
+        frames = {}
+
+        def flush(sid):
+            batch = frames.pop(sid, None)
+            if batch is None:
+                return
+            if len(batch) == 1:
+                frame = batch[0][0]
+            else:
+                # put together from the messages encoded once for every socket they go to
+                frame = '{"type":"batch","data":[' + ",".join(x[0] for x in batch) + ']}'
+            self.enqueue(frame, all(x[1] for x in batch), sid)
+
+        for event, data, sid in messages:
+            if event == "executing" and sid is not None:
+                self.track_executing(data, sid)
+            binary = isinstance(event, int) or isinstance(data, (bytes, bytearray))
+            frame = None
+            for x in (list(self.sockets) if sid is None else [sid]):
+                if x not in self.sockets:
+                    continue
+                if frame is None:
+                    frame = self.encode_frame(event, data)
+                if binary:
+                    flush(x)
+                elif self.sockets[x].batch:
+                    frames.setdefault(x, []).append(frame)
+                    continue
+                self.enqueue(frame[0], frame[1], x)
+
+        for sid in list(frames):
+            flush(sid)
+
     async def start(self, address, port, verbose=True, call_on_start=None):
         runner = web.AppRunner(self.app, access_log=None)
         await runner.setup()
@@ -0,0 +1,104 @@
+import os
+import random
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+from comfy_execution.fair_share import FairShareQueue, TENANT_KEYS
+
+
+def record(number, client_id):
+    extra_data = {} if client_id is None else {"client_id": client_id}
+    return (number, "{}-{}".format(client_id, number), {}, extra_data, [])
+
+
+def queue_of(counts, weights=None, max_running=0):
+    queue = FairShareQueue(TENANT_KEYS["client"], weights, max_running)
+    number = 0
+    for client_id, count in counts:
+        for _ in range(count):
+            queue.push(record(number, client_id))
+            number += 1
+    return queue
+
+
+def drain(queue):
+    out = []
+    while queue.ready():
+        item = queue.pop()
+        out.append(item[3].get("client_id", None))
+        queue.task_done(item)
+    return out
+
+
+class RoundByRound(FairShareQueue):
+    # goes around every round instead of skipping the ones where no tenant reaches 1
+    def skip_rounds(self):
+        pass
+
+
+def test_round_robin_between_clients():
+    queue = queue_of([("a", 5), ("b", 2), ("c", 1)])
+    assert drain(queue) == ["a", "b", "c", "a", "b", "a", "a", "a"]
+    assert len(queue) == 0 and queue.deficit == {}
+
+
+def test_weights_and_deficit():
+    queue = queue_of([("a", 6), ("b", 6)], weights={"a": 2, "b": 0.5})
+    # b reaches 1 every other turn, a starts 2 per turn
+    assert drain(queue) == ["a", "a", "a", "a", "b", "a", "a"] + ["b"] * 5
+
+
+def test_unused_credit_is_lost_when_a_client_empties():
+    queue = queue_of([("a", 1), ("b", 3)], weights={"a": 1.5})
+    assert queue.pop()[3]["client_id"] == "a"
+    assert "a" not in queue.deficit
+    queue.push(record(10, "a"))
+    queue.push(record(11, "a"))
+    # with the 0.5 left from before a would start both in one turn
+    assert drain(queue) == ["b", "a", "b", "a", "b"]
+
+
+def test_prompts_without_a_client_share_one_tenant():
+    queue = queue_of([(None, 3), ("a", 1)])
+    assert drain(queue) == [None, "a", None, None]
+
+
+def test_max_running_lets_the_others_through():
+    queue = queue_of([("a", 4), ("b", 2)], max_running=1)
+    first = queue.pop()
+    second = queue.pop()
+    assert [first[3]["client_id"], second[3]["client_id"]] == ["a", "b"]
+    assert not queue.ready()
+    queue.task_done(second)
+    assert queue.pop()[3]["client_id"] == "b"
+    assert not queue.ready()
+    queue.task_done(first)
+    assert queue.ready()
+    assert queue.stats()["tenants"]["a"] == {"pending": 3, "running": 0, "weight": 1}
+
+
+def test_skipping_rounds_gives_the_same_order():
+    rng = random.Random(1)
+    for _ in range(200):
+        clients = ["c{}".format(i) for i in range(rng.randint(1, 5))]
+        # exact in binary, so adding a weight up round by round comes out the same as multiplying it
+        weights = {x: rng.choice([1 / 1024, 1 / 64, 0.375, 1, 2.5]) for x in clients}
+        counts = [(rng.choice(clients), rng.randint(1, 5)) for _ in range(10)]
+        skipping = queue_of(counts, weights)
+        expected = queue_of(counts, weights)
+        expected.__class__ = RoundByRound
+        assert drain(skipping) == drain(expected)
+
+
+def test_remove_and_front_order_within_a_client():
+    queue = queue_of([("a", 3), ("b", 2)])
+    assert queue.remove("a-1")[1] == "a-1"
+    assert queue.remove("a-1") is None
+    # pushing a queued prompt again with a lower number, like move_to_front does
+    queue.push((-1, "a-2", {}, {"client_id": "a"}, []))
+    assert queue.get("a-2")[0] == -1
+    order = []
+    while queue.ready():
+        order.append(queue.pop()[1])
+    assert order == ["a-2", "b-3", "a-0", "b-4"]
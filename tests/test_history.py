@@ -0,0 +1,86 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+from comfy_execution.history import HistoryStore
+
+
+def fill(store, count, client_of=None, status_of=None, size=10):
+    for i in range(count):
+        client_id = client_of(i) if client_of else None
+        status = status_of(i) if status_of else "success"
+        store.add("p{}".format(i), {"outputs": {}}, client_id, status, size)
+
+
+def test_max_items_evicts_the_oldest():
+    store = HistoryStore(max_items=3)
+    fill(store, 3)
+    assert store.add("p3", {"outputs": {}}, None, "success", 10) == ["p0"]
+    assert list(store.page()) == ["p1", "p2", "p3"]
+    assert "p0" not in store and store.get("p3")["index"] == 3
+
+
+def test_many_evictions_keep_paging_right():
+    # enough evictions for the SeqLists to compact
+    store = HistoryStore(max_items=10)
+    fill(store, 500, client_of=lambda i: i % 2)
+    assert len(store) == 10
+    assert list(store.page(max_items=2, offset=0)) == ["p490", "p491"]
+    assert list(store.page(max_items=2, before=495)) == ["p493", "p494"]
+    assert list(store.page(client_id=1)) == ["p491", "p493", "p495", "p497", "p499"]
+
+
+def test_max_bytes_evicts_until_it_fits():
+    store = HistoryStore(max_bytes=100)
+    fill(store, 5, size=20)
+    assert store.add("big", {"outputs": {}}, None, "success", 50) == ["p0", "p1", "p2"]
+    assert store.bytes == 90
+    # the newest entry stays even when it alone is over the limit
+    assert store.add("huge", {"outputs": {}}, None, "success", 500) == ["p3", "p4", "big"]
+    assert list(store.page()) == ["huge"]
+    assert store.stats() == {"entries": 1, "max_items": None, "bytes": 500, "max_bytes": 100}
+
+
+def test_adding_again_moves_to_the_end():
+    store = HistoryStore()
+    fill(store, 3)
+    store.add("p0", {"outputs": {}}, None, "success", 10)
+    assert list(store.page()) == ["p1", "p2", "p0"]
+    assert store.get("p0")["index"] == 3
+    assert store.bytes == 30
+
+
+def test_page_by_offset():
+    store = HistoryStore()
+    fill(store, 10)
+    assert list(store.page(max_items=3)) == ["p7", "p8", "p9"]
+    assert list(store.page(max_items=3, offset=2)) == ["p2", "p3", "p4"]
+    assert list(store.page(offset=8)) == ["p8", "p9"]
+    assert len(store.page()) == 10
+
+
+def test_page_by_cursor_after_eviction():
+    store = HistoryStore(max_items=6)
+    fill(store, 10)
+    # p0 to p3 are evicted, the indexes of the others don't change
+    assert list(store.page(max_items=2, before=6)) == ["p4", "p5"]
+    assert list(store.page(max_items=2, after=6)) == ["p7", "p8"]
+    assert list(store.page(after=7)) == ["p8", "p9"]
+    assert list(store.page(max_items=3, before=2)) == []
+
+
+def test_page_by_client_and_status():
+    store = HistoryStore()
+    fill(store, 10, client_of=lambda i: "a" if i % 2 == 0 else "b",
+         status_of=lambda i: "error" if i % 3 == 0 else "success")
+    assert list(store.page(client_id="a")) == ["p0", "p2", "p4", "p6", "p8"]
+    assert list(store.page(max_items=2, client_id="b")) == ["p7", "p9"]
+    assert list(store.page(status="error")) == ["p0", "p3", "p6", "p9"]
+    assert list(store.page(max_items=2, after=3, status="error")) == ["p6", "p9"]
+    # the page of the client, filtered by status
+    assert list(store.page(max_items=3, client_id="a", status="error")) == ["p6"]
+
+    store.remove("p6")
+    assert list(store.page(client_id="a", status="error")) == ["p0"]
+    assert list(store.page(status="error")) == ["p0", "p3", "p9"]
@@ -0,0 +1,110 @@
+import heapq
+import os
+import random
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+from comfy_execution.prompt_heap import PromptHeap
+
+
+def record(number, prompt_id):
+    return (number, prompt_id, {}, {}, [])
+
+
+def check(heap):
+    # heap order holds and every position points at its record
+    for i, item in enumerate(heap.items):
+        assert heap.positions[item[1]] == i
+        for child in (2 * i + 1, 2 * i + 2):
+            if child < len(heap.items):
+                assert not heap.items[child] < item
+    assert len(heap.positions) == len(heap.items)
+
+
+def drain(heap):
+    out = []
+    while len(heap) > 0:
+        out.append(heap.pop()[1])
+    return out
+
+
+def test_pops_in_number_order():
+    heap = PromptHeap()
+    for number in (5, 1, 4, 2, 3):
+        heap.push(record(number, "p{}".format(number)))
+    check(heap)
+    assert heap.first()[1] == "p1"
+    assert drain(heap) == ["p1", "p2", "p3", "p4", "p5"]
+
+
+def test_remove_anywhere():
+    heap = PromptHeap()
+    for number in range(10):
+        heap.push(record(number, "p{}".format(number)))
+    assert heap.remove("p4") == record(4, "p4")
+    assert heap.remove("p0") == record(0, "p0")
+    assert heap.remove("p4") is None
+    assert "p4" not in heap and heap.get("p4") is None
+    check(heap)
+    assert drain(heap) == ["p1", "p2", "p3", "p5", "p6", "p7", "p8", "p9"]
+
+
+def test_push_of_a_queued_prompt_replaces_it():
+    heap = PromptHeap()
+    for number in range(5):
+        heap.push(record(number, "p{}".format(number)))
+    # like move_to_front, a lower number than every other
+    heap.push(record(-1, "p3"))
+    check(heap)
+    assert len(heap) == 5
+    heap.replace(record(10, "p0"))
+    check(heap)
+    assert drain(heap) == ["p3", "p1", "p2", "p4", "p0"]
+
+
+def test_random_changes_match_heapq():
+    rng = random.Random(0)
+    heap = PromptHeap()
+    numbers = {}
+    for step in range(2000):
+        prompt_id = "p{}".format(rng.randrange(100))
+        action = rng.random()
+        if action < 0.5:
+            numbers[prompt_id] = rng.randrange(-50, 50)
+            heap.push(record(numbers[prompt_id], prompt_id))
+        elif action < 0.8:
+            item = heap.remove(prompt_id)
+            assert (item is None) == (numbers.pop(prompt_id, None) is None)
+        elif len(heap) > 0:
+            item = heap.pop()
+            assert item == min(record(n, x) for x, n in numbers.items())
+            del numbers[item[1]]
+        if step % 100 == 0:
+            check(heap)
+    expected = [record(n, x) for x, n in numbers.items()]
+    heapq.heapify(expected)
+    assert drain(heap) == [heapq.heappop(expected)[1] for _ in range(len(numbers))]
+
+
+class Server:
+    number = 0
+
+    def queue_updated(self):
+        pass
+
+
+def test_move_to_front_and_delete_on_the_prompt_queue():
+    import execution
+
+    queue = execution.PromptQueue(Server())
+    for number in range(6):
+        queue.put(record(number, "p{}".format(number)))
+    assert queue.move_to_front(["p4", "missing", "p2", "p4"]) == 2
+    assert queue.delete_queue_items(["p0", "missing"]) == 1
+    # moved again, ahead of the ones moved before
+    assert queue.move_to_front(["p5"]) == 1
+    assert sorted((x[0], x[1]) for x in queue.get_current_queue()[1]) == [(-3, "p5"), (-2, "p2"), (-1, "p4"),
+                                                                         (1, "p1"), (3, "p3")]
+    check(queue.queue)
+    assert [queue.get()[0][1] for _ in range(5)] == ["p5", "p2", "p4", "p1", "p3"]
@@ -0,0 +1,30 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+from comfy_execution.queue_store import SQLiteQueueStore
+
+
+def record(number, prompt_id, extra_data=None):
+    return (number, prompt_id, {"1": {"class_type": "Note", "inputs": {}}}, extra_data or {}, ["1"])
+
+
+def test_unpicklable_changes_dont_roll_back_the_batch(tmp_path):
+    path = str(tmp_path / "queue.db")
+    store = SQLiteQueueStore(path, sync_interval=60)
+    for i in range(1, 4):
+        store.put(record(i, "p{}".format(i)))
+    store.put(record(4, "p4", {"client_id": "a", "callback": lambda: None}))
+    store.start(record(1, "p1"))
+    store.done("p1", {"index": 0, "outputs": {"1": {"ui": lambda: None}}}, "a", "success", 10)
+    store.start(record(2, "p2"))
+    store.done("p2", {"index": 1, "outputs": {"1": {"text": ["ok"]}}}, "a", "success", 10)
+    # everything above is written by close, in one batch
+    store.close()
+
+    store = SQLiteQueueStore(path, sync_interval=60)
+    pending, history = store.load()
+    store.close()
+    assert [x[1] for x in pending] == ["p3"]
+    assert [(x[0], x[1]["outputs"]) for x in history] == [("p2", {"1": {"text": ["ok"]}})]
@@ -53,9 +53,10 @@ class ComfyApi extends EventTarget {
 		}
 
 		let opened = false;
-		let existingSession = window.name;
-		if (existingSession) {
-			existingSession = "?clientId=" + existingSession;
+		// batch=1 lets the server group events into {"type": "batch"} frames when it publishes in batches
+		let existingSession = "?batch=1";
+		if (window.name) {
+			existingSession += "&clientId=" + window.name;
 		}
 		this.socket = new WebSocket(
 			`ws${window.location.protocol === "https:" ? "s" : ""}://${this.api_host}${this.api_base}/ws${existingSession}`
@@ -114,7 +115,9 @@ class ComfyApi extends EventTarget {
 					}
 				}
 				else {
-				    const msg = JSON.parse(event.data);
+				    const data = JSON.parse(event.data);
+				    for (const msg of data.type === "batch" ? data.data : [data]) {
+				    try {
 				    switch (msg.type) {
 					    case "status":
 						    if (msg.data.sid) {
@@ -152,6 +155,10 @@ class ComfyApi extends EventTarget {
 							    throw new Error(`Unknown message type ${msg.type}`);
 						    }
 				    }
+				    } catch (error) {
+					    console.warn("Unhandled message:", msg, error);
+				    }
+				    }
 				}
 			} catch (error) {
 				console.warn("Unhandled message:", event.data, error);
@@ -189,7 +196,8 @@ class ComfyApi extends EventTarget {
 	 * @returns The node definitions
 	 */
 	async getNodeDefs() {
-		const resp = await this.fetchApi("/object_info", { cache: "no-store" });
+		// revalidated with the ETag of the cached copy, unchanged node definitions aren't downloaded again
+		const resp = await this.fetchApi("/object_info", { cache: "no-cache" });
 		return await resp.json();
 	}
 